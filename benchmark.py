@@ -0,0 +1,194 @@
+# Offline benchmark for the license API. Seeds a throwaway keys.db with synthetic keys,
+# drives the Flask routes from concurrent workers without Discord or network access and
+# prints throughput and latency percentiles as JSON.
+#
+#   python benchmark.py --sizes 10000,100000,1000000 --requests 50000 --concurrency 16
+#   python benchmark.py --mode http --output results.json
+import argparse
+import atexit
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+# Point the bot at a scratch database before importing it
+BENCH_DIR = tempfile.mkdtemp(prefix="zhacks-bench-")
+atexit.register(shutil.rmtree, BENCH_DIR, ignore_errors=True)
+os.environ["DB_PATH"] = os.path.join(BENCH_DIR, "keys.db")
+# Every worker shares 127.0.0.1, so the per-IP limiter would reject most of the load
+os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+
+# Keep stdout for the JSON report; the bot prints migration notices on import
+with contextlib.redirect_stdout(sys.stderr):
+    import bot  # noqa: E402
+
+ROUTES = ["/check_key", "/check_uid", "/register_uid"]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the license API offline.")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="comma-separated key table sizes")
+    parser.add_argument("--requests", type=int, default=20000, help="requests per table size")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent client threads")
+    parser.add_argument("--mix", default="70,25,5", help="percent of check_key,check_uid,register_uid")
+    parser.add_argument("--invalid-ratio", type=float, default=0.05, help="share of requests using unknown keys")
+    parser.add_argument("--mode", choices=["inprocess", "http"], default="inprocess",
+                        help="call the WSGI app directly or through the waitress server on localhost")
+    parser.add_argument("--port", type=int, default=5099, help="port for --mode http")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    return parser.parse_args()
+
+def synthetic_key(i):
+    return f"{i:08X}"
+
+# Replace the key table with `size` synthetic keys; every other key has a registered UID
+def seed_keys(size):
+    now = int(time.time())
+    rows = ((synthetic_key(i), str(100000000000000000 + i), now + 86400 * 30, "active", now,
+             f"uid-{i}" if i % 2 else None) for i in range(size))
+    with bot.db_cursor() as cursor:
+        cursor.execute("DELETE FROM keys")
+        cursor.executemany("INSERT INTO keys (key, user_id, expiration, status, registration_date, android_uid) VALUES (?, ?, ?, ?, ?, ?)", rows)
+    with bot.db_cursor() as cursor:
+        cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    bot.key_cache.clear()
+
+def build_request(rng, size, weights, invalid_ratio):
+    route = rng.choices(ROUTES, weights=weights)[0]
+    i = rng.randrange(size)
+    key = synthetic_key(size + i) if rng.random() < invalid_ratio else synthetic_key(i)
+    if route == "/check_key":
+        return route, f"/check_key?key={key}"
+    if route == "/check_uid":
+        return route, f"/check_uid?key={key}&android_uid=uid-{i}"
+    return route, f"/register_uid?key={key}&discord_id={100000000000000000 + i}&android_uid=uid-{i}"
+
+def make_client(mode, port):
+    if mode == "inprocess":
+        client = bot.app.test_client()
+        return lambda path: client.get(path).status_code
+    import http.client
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    def call(path):
+        conn.request("GET", path)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    return call
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def summarize(latencies, elapsed, errors):
+    values = sorted(latencies)
+    return {
+        "requests": len(values),
+        "errors": errors,
+        "throughput_rps": round(len(values) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(values, 0.50) * 1000, 3) if values else None,
+        "p99_ms": round(percentile(values, 0.99) * 1000, 3) if values else None,
+        "max_ms": round(values[-1] * 1000, 3) if values else None
+    }
+
+def run_size(args, size, weights):
+    seed_keys(size)
+    per_worker = args.requests // args.concurrency
+    results = {route: [] for route in ROUTES}
+    errors = {route: 0 for route in ROUTES}
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(args.concurrency + 1)
+
+    def worker(worker_id):
+        rng = random.Random(args.seed * 1000003 + worker_id)
+        call = make_client(args.mode, args.port)
+        plan = [build_request(rng, size, weights, args.invalid_ratio) for _ in range(per_worker)]
+        local = {route: [] for route in ROUTES}
+        local_errors = {route: 0 for route in ROUTES}
+        start_barrier.wait()
+        for route, path in plan:
+            started = time.perf_counter()
+            status = call(path)
+            local[route].append(time.perf_counter() - started)
+            if status >= 500:
+                local_errors[route] += 1
+        with lock:
+            for route in ROUTES:
+                results[route] += local[route]
+                errors[route] += local_errors[route]
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    start_barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    all_latencies = [value for route in ROUTES for value in results[route]]
+    return {
+        "size": size,
+        "elapsed_s": round(elapsed, 3),
+        "overall": summarize(all_latencies, elapsed, sum(errors.values())),
+        "routes": {route: summarize(results[route], elapsed, errors[route]) for route in ROUTES},
+        "key_cache": bot.key_cache.stats()
+    }
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    args = parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    weights = [float(weight) for weight in args.mix.split(",")]
+    if len(weights) != len(ROUTES):
+        sys.exit("--mix needs one weight per route: check_key,check_uid,register_uid")
+
+    # No Discord connection: side effects only queue up in the (unstarted) log sink and reconciler
+    bot.registry.guild = None
+
+    if args.mode == "http":
+        threading.Thread(target=bot.run_api_server, args=(args.port,), daemon=True).start()
+        time.sleep(1)
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "sqlite": bot.sqlite3.sqlite_version,
+        "mode": args.mode,
+        "api_server": bot.API_SERVER if args.mode == "http" else None,
+        "concurrency": args.concurrency,
+        "requests_per_size": args.requests,
+        "mix": dict(zip(ROUTES, weights)),
+        "invalid_ratio": args.invalid_ratio,
+        "results": []
+    }
+    for size in sizes:
+        print(f"Benchmarking {size} keys...", file=sys.stderr)
+        report["results"].append(run_size(args, size, weights))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as fp:
+            fp.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
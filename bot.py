@@ -4,13 +4,31 @@ from discord.ui import Button, View, Modal, TextInput
 from discord.ext import commands, tasks
 import sqlite3
 from datetime import datetime, timedelta
-import random
+import secrets
 import string
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request
 from flask_cors import CORS
 import threading
+import queue
+import time
+import asyncio
+import heapq
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from dotenv import load_dotenv
 import os
+import json
+import re
+import io
+import csv
+import tempfile
+import functools
+import bisect
+import base64
+import hashlib
+import hmac
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.serialization import Encoding, NoEncryption, PrivateFormat, PublicFormat
 
 # Charger les variables d'environnement
 load_dotenv()
@@ -21,93 +39,1528 @@ intents.message_content = True
 intents.members = True  # Required for role management
 bot = commands.Bot(command_prefix="!", intents=intents)
 
+# Lightweight in-process metrics, exposed in Prometheus text format at /metrics.
+# Each observation is one short lock acquisition, cheap enough to leave on under load.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in self._values.items():
+                lines.append(f"{self.name}{format_labels(labels)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series = {}  # labels -> [per-bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for labels, values in series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {values[-1]}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {cumulative}")
+        return lines
+
+http_requests_total = Counter("zhacks_http_requests_total", "API requests by route, method and status.")
+http_request_seconds = Histogram("zhacks_http_request_duration_seconds", "API request latency by route.")
+sqlite_query_seconds = Histogram("zhacks_sqlite_query_duration_seconds", "SQLite statement execution time.")
+expire_run_seconds = Histogram("zhacks_expire_keys_duration_seconds", "check_expired_keys run duration.")
+rate_limited_total = Counter("zhacks_rate_limited_total", "API requests rejected by the rate limiter by route and scope.")
+
+# Cursor that records every statement's execution time
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, *args):
+        with sqlite_query_seconds.time():
+            return super().execute(*args)
+
+    def executemany(self, *args):
+        with sqlite_query_seconds.time():
+            return super().executemany(*args)
+
 # SQLite database
-db = sqlite3.connect("keys.db", check_same_thread=False)
-cursor = db.cursor()
-
-# Create table for keys (with android_uid)
-cursor.execute('''CREATE TABLE IF NOT EXISTS keys (
-    key TEXT PRIMARY KEY,
-    user_id TEXT,
-    expiration TEXT,
-    status TEXT,
-    registration_date TEXT,
-    android_uid TEXT
-)''')
-
-# Create table for banned users
-cursor.execute('''CREATE TABLE IF NOT EXISTS banned_users (
-    user_id TEXT PRIMARY KEY
-)''')
-
-# Create table for maintenance mode
-cursor.execute('''CREATE TABLE IF NOT EXISTS maintenance (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    active BOOLEAN NOT NULL,
-    end_time TEXT,
-    last_updated TEXT
-)''')
-db.commit()
-
-# Initialize maintenance state if not exists
-cursor.execute("SELECT * FROM maintenance WHERE id = 1")
-if not cursor.fetchone():
-    cursor.execute("INSERT INTO maintenance (id, active, end_time, last_updated) VALUES (?, ?, ?, ?)",
-                   (1, False, None, datetime.now().isoformat()))
-    db.commit()
+DB_PATH = os.getenv("DB_PATH", "keys.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 16))
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", 16384))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", 5000))
+
+# Process role: "all" runs the API and the bot in one process; "api" and "bot" split
+# them, sharing keys.db. Split processes publish cache changes through sync_events.
+PROCESS_ROLE = os.getenv("PROCESS_ROLE", "all")
+if PROCESS_ROLE not in ("all", "api", "bot"):
+    raise ValueError(f"Unknown PROCESS_ROLE: {PROCESS_ROLE}")
+
+# Connection pool: every Flask worker thread and the bot loop check out their own
+# connection, so result sets are never shared and readers don't wait on writers (WAL)
+class ConnectionPool:
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._open()
+
+    def close_idle(self):
+        # Before fork: SQLite handles must not be carried into a child process
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def reset(self):
+        # After fork: start from an empty pool, never touching inherited handles
+        self._idle = queue.LifoQueue(maxsize=self.size)
+
+    def release(self, conn):
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    @contextmanager
+    def cursor(self):
+        # Commits on success, rolls back on error. Never await inside the block:
+        # the connection is held until it exits.
+        conn = self.acquire()
+        cur = conn.cursor(TimedCursor)
+        try:
+            yield cur
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            cur.close()
+            self.release(conn)
+
+db_pool = ConnectionPool(DB_PATH, DB_POOL_SIZE)
+db_cursor = db_pool.cursor
+
+# Keys store expiration and registration_date as REAL epochs, keeping the microseconds
+# of the original ISO strings; the API and the Discord messages keep showing them in
+# the original ISO / date formats
+def to_epoch(dt):
+    return dt.timestamp()
+
+def epoch_to_iso(epoch):
+    return datetime.fromtimestamp(epoch).isoformat() if epoch is not None else None
+
+def epoch_to_date(epoch):
+    return datetime.fromtimestamp(epoch).strftime('%Y-%m-%d') if epoch is not None else None
+
+def iso_to_epoch(value):
+    return to_epoch(datetime.fromisoformat(value)) if value else None
+
+# Schema migrations, applied in order and recorded in schema_version
+def migration_initial_schema(cursor):
+    # Create table for keys (with android_uid)
+    cursor.execute('''CREATE TABLE IF NOT EXISTS keys (
+        key TEXT PRIMARY KEY,
+        user_id TEXT,
+        expiration TEXT,
+        status TEXT,
+        registration_date TEXT,
+        android_uid TEXT
+    )''')
+
+    # Create table for banned users
+    cursor.execute('''CREATE TABLE IF NOT EXISTS banned_users (
+        user_id TEXT PRIMARY KEY
+    )''')
+
+    # Create table for maintenance mode
+    cursor.execute('''CREATE TABLE IF NOT EXISTS maintenance (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        active BOOLEAN NOT NULL,
+        end_time TEXT,
+        last_updated TEXT
+    )''')
+
+    # Initialize maintenance state if not exists
+    cursor.execute("SELECT * FROM maintenance WHERE id = 1")
+    if not cursor.fetchone():
+        cursor.execute("INSERT INTO maintenance (id, active, end_time, last_updated) VALUES (?, ?, ?, ?)",
+                       (1, False, None, datetime.now().isoformat()))
+
+def migration_typed_keys(cursor):
+    # Rebuild keys with epoch timestamps and a constrained status, then index it.
+    # The ISO strings are naive local times, so convert them in Python, not strftime('%s').
+    cursor.connection.create_function("iso_to_epoch", 1, iso_to_epoch)
+    cursor.execute('''CREATE TABLE keys_typed (
+        key TEXT PRIMARY KEY,
+        user_id TEXT,
+        expiration REAL,
+        status TEXT NOT NULL DEFAULT 'active' CHECK (status IN ('active', 'inactive')),
+        registration_date REAL,
+        android_uid TEXT
+    )''')
+    cursor.execute('''INSERT INTO keys_typed (key, user_id, expiration, status, registration_date, android_uid)
+        SELECT key, user_id, iso_to_epoch(expiration),
+               CASE status WHEN 'active' THEN 'active' ELSE 'inactive' END,
+               iso_to_epoch(registration_date), android_uid
+        FROM keys''')
+    cursor.execute("DROP TABLE keys")
+    cursor.execute("ALTER TABLE keys_typed RENAME TO keys")
+    cursor.execute("CREATE INDEX idx_keys_user_id ON keys (user_id)")
+    cursor.execute("CREATE INDEX idx_keys_android_uid ON keys (android_uid)")
+    cursor.execute("CREATE INDEX idx_keys_status_expiration ON keys (status, expiration)")
+
+def migration_guild_registry(cursor):
+    cursor.execute('''CREATE TABLE guild_registry (
+        kind TEXT NOT NULL,
+        name TEXT NOT NULL,
+        object_id INTEGER NOT NULL,
+        PRIMARY KEY (kind, name)
+    )''')
+
+def migration_usage_events(cursor):
+    # Raw usage events plus hourly/daily rollups keyed by (bucket start epoch, key, action, ip)
+    cursor.execute('''CREATE TABLE usage_events (
+        id INTEGER PRIMARY KEY,
+        ts INTEGER NOT NULL,
+        key TEXT NOT NULL,
+        user_id TEXT,
+        action TEXT NOT NULL,
+        ip TEXT NOT NULL DEFAULT ''
+    )''')
+    cursor.execute("CREATE INDEX idx_usage_events_ts ON usage_events (ts)")
+    for table in ("usage_hourly", "usage_daily"):
+        cursor.execute(f'''CREATE TABLE {table} (
+            bucket INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            action TEXT NOT NULL,
+            ip TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (bucket, key, action, ip)
+        ) WITHOUT ROWID''')
+    cursor.execute('''CREATE TABLE usage_rollup_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        last_event_id INTEGER NOT NULL
+    )''')
+    cursor.execute("INSERT INTO usage_rollup_state (id, last_event_id) VALUES (1, 0)")
+
+def migration_license_revocations(cursor):
+    # AUTOINCREMENT keeps versions increasing even after old rows are pruned
+    cursor.execute('''CREATE TABLE license_revocations (
+        version INTEGER PRIMARY KEY AUTOINCREMENT,
+        key TEXT NOT NULL,
+        revoked_at INTEGER NOT NULL
+    )''')
+
+def migration_outbox(cursor):
+    # Discord side effects queued by API processes for the bot process to deliver
+    cursor.execute('''CREATE TABLE outbox (
+        id INTEGER PRIMARY KEY,
+        kind TEXT NOT NULL CHECK (kind IN ('log', 'vip')),
+        payload TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at INTEGER NOT NULL DEFAULT 0,
+        created_at INTEGER NOT NULL
+    )''')
+    cursor.execute("CREATE INDEX idx_outbox_next_attempt ON outbox (next_attempt_at, id)")
+    # Cache changes made by one process for the others to apply
+    cursor.execute('''CREATE TABLE sync_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        value TEXT,
+        created_at INTEGER NOT NULL
+    )''')
+
+def migration_control_messages(cursor):
+    cursor.execute('''CREATE TABLE control_messages (
+        name TEXT PRIMARY KEY,
+        channel_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        fingerprint TEXT NOT NULL
+    )''')
+
+def migration_setup_state(cursor):
+    cursor.execute('''CREATE TABLE setup_state (
+        step TEXT PRIMARY KEY,
+        object_id INTEGER,
+        completed_at INTEGER NOT NULL,
+        duration_ms INTEGER NOT NULL
+    )''')
+
+def migration_tickets(cursor):
+    cursor.execute('''CREATE TABLE tickets (
+        id INTEGER PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        type TEXT NOT NULL,
+        status TEXT NOT NULL CHECK (status IN ('opening', 'open', 'closed')),
+        channel_id INTEGER,
+        opened_at INTEGER NOT NULL,
+        closed_at INTEGER,
+        closed_by TEXT
+    )''')
+    # At most one unclosed ticket per user and type
+    cursor.execute("CREATE UNIQUE INDEX idx_tickets_open ON tickets (user_id, type) WHERE status != 'closed'")
+    cursor.execute("CREATE INDEX idx_tickets_channel_id ON tickets (channel_id)")
+    cursor.execute('''CREATE TABLE ticket_messages (
+        ticket_id INTEGER NOT NULL REFERENCES tickets (id),
+        message_id INTEGER NOT NULL,
+        author_id TEXT NOT NULL,
+        author_name TEXT NOT NULL,
+        created_at INTEGER NOT NULL,
+        content TEXT NOT NULL,
+        attachments TEXT NOT NULL,
+        PRIMARY KEY (ticket_id, message_id)
+    )''')
+
+def migration_audit_log(cursor):
+    cursor.execute('''CREATE TABLE audit_log (
+        id INTEGER PRIMARY KEY,
+        ts INTEGER NOT NULL,
+        actor_id TEXT NOT NULL,
+        actor_name TEXT NOT NULL,
+        action TEXT NOT NULL,
+        target_key TEXT,
+        target_user TEXT,
+        before TEXT,
+        after TEXT
+    )''')
+    cursor.execute("CREATE INDEX idx_audit_log_target_key ON audit_log (target_key, ts)")
+    cursor.execute("CREATE INDEX idx_audit_log_target_user ON audit_log (target_user, ts)")
+    cursor.execute("CREATE INDEX idx_audit_log_ts ON audit_log (ts)")
+    for statement in ("UPDATE", "DELETE"):
+        cursor.execute(f'''CREATE TRIGGER audit_log_no_{statement.lower()} BEFORE {statement} ON audit_log
+            BEGIN SELECT RAISE(ABORT, 'audit_log is append-only'); END''')
+
+def migration_usage_events_autoincrement(cursor):
+    # Plain rowids are reused once prune() empties the table, landing new events below
+    # the rollup watermark. Rebuild with AUTOINCREMENT and start past the watermark.
+    cursor.execute('''CREATE TABLE usage_events_seq (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts INTEGER NOT NULL,
+        key TEXT NOT NULL,
+        user_id TEXT,
+        action TEXT NOT NULL,
+        ip TEXT NOT NULL DEFAULT ''
+    )''')
+    cursor.execute("INSERT INTO usage_events_seq (id, ts, key, user_id, action, ip) SELECT id, ts, key, user_id, action, ip FROM usage_events")
+    cursor.execute("DROP TABLE usage_events")
+    cursor.execute("ALTER TABLE usage_events_seq RENAME TO usage_events")
+    cursor.execute("CREATE INDEX idx_usage_events_ts ON usage_events (ts)")
+    cursor.execute("DELETE FROM sqlite_sequence WHERE name = 'usage_events'")
+    cursor.execute('''INSERT INTO sqlite_sequence (name, seq) SELECT 'usage_events', MAX(
+        (SELECT COALESCE(MAX(id), 0) FROM usage_events),
+        (SELECT last_event_id FROM usage_rollup_state WHERE id = 1))''')
+
+MIGRATIONS = [
+    (1, "initial schema", migration_initial_schema),
+    (2, "typed keys table with indexes", migration_typed_keys),
+    (3, "guild registry", migration_guild_registry),
+    (4, "usage events and rollups", migration_usage_events),
+    (5, "license token revocations", migration_license_revocations),
+    (6, "outbox and sync events", migration_outbox),
+    (7, "control panel messages", migration_control_messages),
+    (8, "setup state", migration_setup_state),
+    (9, "tickets", migration_tickets),
+    (10, "audit log", migration_audit_log),
+    (11, "usage events without rowid reuse", migration_usage_events_autoincrement),
+]
+
+def run_migrations():
+    with db_cursor() as cursor:
+        cursor.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at INTEGER NOT NULL
+        )''')
+    for version, description, migrate in MIGRATIONS:
+        with db_cursor() as cursor:
+            # Re-check under the write lock so concurrent processes apply each migration once
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,))
+            if cursor.fetchone():
+                continue
+            migrate(cursor)
+            cursor.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                           (version, description, int(time.time())))
+        print(f"Applied schema migration {version}: {description}")
+
+run_migrations()
+
+# Tell other processes about a cache change; a no-op when everything runs in one process
+def publish_sync_events(cursor, kind, values=(None,)):
+    if PROCESS_ROLE == "all":
+        return
+    now = int(time.time())
+    cursor.executemany("INSERT INTO sync_events (kind, value, created_at) VALUES (?, ?, ?)",
+                       [(kind, value, now) for value in values])
+
+# In-memory cache of key rows in front of the API lookups. Every write path calls
+# key_cache.invalidate() after committing; the version counter stops a lookup that
+# raced with a write from caching the stale row it read. In split deployments the
+# invalidation is also published to the other processes.
+KEY_CACHE_SIZE = int(os.getenv("KEY_CACHE_SIZE", 10000))
+KEY_CACHE_TTL = float(os.getenv("KEY_CACHE_TTL", 300))
+
+class KeyCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._rows = OrderedDict()  # key -> (row or None, expires_at)
+        self._lock = threading.Lock()
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._rows.get(key)
+            if entry and entry[1] > now:
+                self._rows.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            version = self._version
+        with db_cursor() as cursor:
+            cursor.execute("SELECT * FROM keys WHERE key = ?", (key,))
+            row = cursor.fetchone()
+        with self._lock:
+            if version == self._version:
+                self._rows[key] = (row, now + self.ttl)
+                self._rows.move_to_end(key)
+                while len(self._rows) > self.max_size:
+                    self._rows.popitem(last=False)
+                    self.evictions += 1
+        return row
+
+    def invalidate(self, *keys, publish=True):
+        with self._lock:
+            self._version += 1
+            for key in keys:
+                self._rows.pop(key, None)
+        if publish and keys and PROCESS_ROLE != "all":
+            with db_cursor() as cursor:
+                publish_sync_events(cursor, "key", keys)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._rows.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._rows),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+key_cache = KeyCache(KEY_CACHE_SIZE, KEY_CACHE_TTL)
+
+# Process-wide maintenance state. Readers only compare the clock against the cached
+# window, so an elapsed window expires by itself without touching the database.
+class MaintenanceState:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._window = None  # (end_time datetime, end_time ISO string) or None
+
+    def load(self):
+        with db_cursor() as cursor:
+            cursor.execute("SELECT active, end_time FROM maintenance WHERE id = 1")
+            row = cursor.fetchone()
+        with self._lock:
+            if row and row[0] and row[1]:
+                self._window = (datetime.fromisoformat(row[1]), row[1])
+            else:
+                self._window = None
+            self._changed.notify_all()
+
+    def is_active(self):
+        window = self._window
+        return window is not None and datetime.now() < window[0]
+
+    def end_time(self):
+        # Current end time, or None when no window is set (even an elapsed one)
+        window = self._window
+        return window[0] if window else None
+
+    def status(self):
+        window = self._window
+        if window is None or datetime.now() > window[0]:
+            return {"active": False, "end_time": None}
+        return {"active": True, "end_time": window[1]}
+
+    def etag(self):
+        # Derived from the state itself so every process agrees on it
+        window = self._window
+        if window is None or datetime.now() >= window[0]:
+            return "0"
+        return f"1-{to_epoch(window[0])}"
+
+    def seconds_left(self):
+        window = self._window
+        return max(0.0, (window[0] - datetime.now()).total_seconds()) if window else 0.0
+
+    def wait(self, etag, timeout):
+        # Block until the ETag differs from the given one or the timeout passes
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while self.etag() == etag:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                if self.is_active():
+                    remaining = min(remaining, self.seconds_left() + 0.05)
+                self._changed.wait(remaining)
+        return True
+
+    def enable(self, end_time):
+        end_time_iso = end_time.isoformat()
+        with self._lock:
+            with db_cursor() as cursor:
+                cursor.execute("UPDATE maintenance SET active = ?, end_time = ?, last_updated = ? WHERE id = ?",
+                               (True, end_time_iso, datetime.now().isoformat(), 1))
+                publish_sync_events(cursor, "maintenance")
+            self._window = (end_time, end_time_iso)
+            self._changed.notify_all()
+
+    def disable(self):
+        with self._lock:
+            with db_cursor() as cursor:
+                cursor.execute("UPDATE maintenance SET active = ?, end_time = ?, last_updated = ? WHERE id = ?",
+                               (False, None, datetime.now().isoformat(), 1))
+                publish_sync_events(cursor, "maintenance")
+            self._window = None
+            self._changed.notify_all()
+
+maintenance_state = MaintenanceState()
+maintenance_state.load()
+
+# Ban list held in memory as an immutable set. Readers never lock or touch SQLite;
+# writers persist first and then swap in a new set.
+BAN_IMPORT_MAX = int(os.getenv("BAN_IMPORT_MAX", 100000))
+
+class BanList:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = frozenset()
+
+    def load(self):
+        with db_cursor() as cursor:
+            cursor.execute("SELECT user_id FROM banned_users")
+            ids = frozenset(row[0] for row in cursor)
+        with self._lock:
+            self._ids = ids
+
+    def is_banned(self, user_id):
+        return str(user_id) in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def ban(self, user_ids):
+        # Ban every ID and purge their keys in one transaction; returns the purged key rows
+        user_ids = list(dict.fromkeys(str(user_id) for user_id in user_ids))
+        batch = json.dumps(user_ids)
+        with self._lock:
+            with db_cursor() as cursor:
+                cursor.executemany("INSERT OR IGNORE INTO banned_users (user_id) VALUES (?)",
+                                   [(user_id,) for user_id in user_ids])
+                cursor.execute("SELECT * FROM keys WHERE user_id IN (SELECT value FROM json_each(?))", (batch,))
+                purged = cursor.fetchall()
+                cursor.execute("DELETE FROM keys WHERE user_id IN (SELECT value FROM json_each(?))", (batch,))
+                record_revocations(cursor, [row[0] for row in purged])
+                publish_sync_events(cursor, "ban", user_ids)
+            self._ids = self._ids.union(user_ids)
+        return purged
+
+    def unban(self, user_ids):
+        user_ids = [str(user_id) for user_id in user_ids]
+        with self._lock:
+            with db_cursor() as cursor:
+                cursor.executemany("DELETE FROM banned_users WHERE user_id = ?", [(user_id,) for user_id in user_ids])
+                publish_sync_events(cursor, "unban", user_ids)
+            self._ids = self._ids.difference(user_ids)
+
+    def apply(self, banned, unbanned):
+        # Apply changes another process already persisted
+        with self._lock:
+            self._ids = self._ids.union(banned).difference(unbanned)
+
+ban_list = BanList()
+ban_list.load()
+
+# Discord log pipeline. Producers (Flask threads and the bot loop) append lines to a
+# bounded buffer; a single task on the bot loop packs them into messages up to the
+# 2000-character limit and sends them, backing off when Discord rate limits us.
+DISCORD_MESSAGE_LIMIT = 2000
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 5000))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", 2))
+LOG_MAX_BACKOFF = float(os.getenv("LOG_MAX_BACKOFF", 60))
+
+class LogSink:
+    def __init__(self, max_lines, flush_interval):
+        self.max_lines = max_lines
+        self.flush_interval = flush_interval
+        self._lines = deque()
+        self._lock = threading.Lock()
+        self._pending_chars = 0
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+        self._backoff = 0
+        self._wake_pending = False
+        self.queued = 0
+        self.dropped = 0
+        self.sent_lines = 0
+        self.sent_messages = 0
+        self.rate_limited = 0
+
+    def log(self, line):
+        line = line[:DISCORD_MESSAGE_LIMIT]
+        with self._lock:
+            if len(self._lines) >= self.max_lines:
+                self.dropped += 1
+                return
+            self._lines.append(line)
+            self.queued += 1
+            self._pending_chars += len(line) + 1
+            wake = self._pending_chars >= DISCORD_MESSAGE_LIMIT and not self._wake_pending
+            if wake:
+                self._wake_pending = True
+        if wake and self._loop:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def is_running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = self._loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            with self._lock:
+                self._wake_pending = False
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Log sink error: {e}")
+            if self._backoff:
+                await asyncio.sleep(self._backoff)
+
+    def _take_batch(self):
+        with self._lock:
+            batch = []
+            length = -1  # no newline before the first line
+            while self._lines and length + len(self._lines[0]) + 1 <= DISCORD_MESSAGE_LIMIT:
+                line = self._lines.popleft()
+                length += len(line) + 1
+                batch.append(line)
+            self._pending_chars -= length + 1
+            return batch
+
+    def _requeue(self, batch):
+        with self._lock:
+            self._lines.extendleft(reversed(batch))
+            self._pending_chars += sum(len(line) + 1 for line in batch)
+            while len(self._lines) > self.max_lines:
+                self._pending_chars -= len(self._lines.pop()) + 1
+                self.dropped += 1
+
+    async def flush(self):
+        log_channel = registry.channel("logs")
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return
+            if not log_channel:
+                with self._lock:
+                    self.dropped += len(batch)
+                continue
+            try:
+                await log_channel.send("\n".join(batch))
+            except discord.HTTPException as e:
+                if e.status != 429:
+                    print(f"Failed to send logs: {e}")
+                    with self._lock:
+                        self.dropped += len(batch)
+                    continue
+                self._requeue(batch)
+                self.rate_limited += 1
+                retry_after = float(e.response.headers.get("Retry-After", 0) or 0)
+                self._backoff = min(max(retry_after, self._backoff * 2, 1), LOG_MAX_BACKOFF)
+                return
+            self._backoff = 0
+            self.sent_lines += len(batch)
+            self.sent_messages += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": len(self._lines),
+                "queued": self.queued,
+                "dropped": self.dropped,
+                "sent_lines": self.sent_lines,
+                "sent_messages": self.sent_messages,
+                "rate_limited": self.rate_limited
+            }
+
+log_sink = LogSink(LOG_QUEUE_SIZE, LOG_FLUSH_INTERVAL)
+
+# Usage history. API threads append events to a bounded buffer; a writer thread
+# inserts them in batches, folds new events into the hourly/daily rollups and
+# prunes rows past their retention.
+USAGE_BUFFER_SIZE = int(os.getenv("USAGE_BUFFER_SIZE", 50000))
+USAGE_BATCH_SIZE = int(os.getenv("USAGE_BATCH_SIZE", 500))
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", 2))
+USAGE_ROLLUP_INTERVAL = float(os.getenv("USAGE_ROLLUP_INTERVAL", 300))
+USAGE_RAW_RETENTION_DAYS = int(os.getenv("USAGE_RAW_RETENTION_DAYS", 7))
+USAGE_HOURLY_RETENTION_DAYS = int(os.getenv("USAGE_HOURLY_RETENTION_DAYS", 90))
+USAGE_DAILY_RETENTION_DAYS = int(os.getenv("USAGE_DAILY_RETENTION_DAYS", 730))
+
+class UsageRecorder:
+    def __init__(self, max_events, batch_size):
+        self.max_events = max_events
+        self.batch_size = batch_size
+        self._events = deque()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._last_rollup = 0
+        self.recorded = 0
+        self.dropped = 0
+        self.written = 0
+
+    def record(self, key, user_id, action, ip):
+        with self._lock:
+            if len(self._events) >= self.max_events:
+                self.dropped += 1
+                return
+            self._events.append((int(time.time()), key, user_id, action, ip or ""))
+            self.recorded += 1
+            wake = len(self._events) >= self.batch_size
+        if wake:
+            self._wakeup.set()
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="usage-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(USAGE_FLUSH_INTERVAL)
+            self._wakeup.clear()
+            try:
+                self.flush()
+                if time.monotonic() - self._last_rollup >= USAGE_ROLLUP_INTERVAL:
+                    self.rollup()
+                    self.prune()
+                    self._last_rollup = time.monotonic()
+            except Exception as e:
+                print(f"Usage writer error: {e}")
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                batch = list(self._events)
+                self._events.clear()
+            if not batch:
+                return
+            try:
+                with db_cursor() as cursor:
+                    cursor.executemany("INSERT INTO usage_events (ts, key, user_id, action, ip) VALUES (?, ?, ?, ?, ?)", batch)
+            except sqlite3.Error:
+                with self._lock:
+                    self._events.extendleft(reversed(batch))
+                    while len(self._events) > self.max_events:
+                        self._events.pop()
+                        self.dropped += 1
+                raise
+            self.written += len(batch)
+
+    def rollup(self):
+        # Fold events past the watermark into both rollups in one transaction
+        with self._write_lock:
+            with db_cursor() as cursor:
+                cursor.execute("BEGIN IMMEDIATE")
+                cursor.execute("SELECT last_event_id FROM usage_rollup_state WHERE id = 1")
+                start = cursor.fetchone()[0]
+                cursor.execute("SELECT MAX(id) FROM usage_events")
+                end = cursor.fetchone()[0]
+                if end is None or end <= start:
+                    return
+                for table, width in (("usage_hourly", 3600), ("usage_daily", 86400)):
+                    cursor.execute(f'''INSERT INTO {table} (bucket, key, action, ip, count)
+                        SELECT ts - ts % {width}, key, action, ip, COUNT(*) FROM usage_events
+                        WHERE id > ? AND id <= ? GROUP BY 1, 2, 3, 4 ORDER BY 1, 2, 3, 4
+                        ON CONFLICT (bucket, key, action, ip) DO UPDATE SET count = count + excluded.count''',
+                                   (start, end))
+                cursor.execute("UPDATE usage_rollup_state SET last_event_id = ? WHERE id = 1", (end,))
+
+    def prune(self):
+        # Raw events are only dropped once they have been rolled up
+        now = int(time.time())
+        with self._write_lock:
+            with db_cursor() as cursor:
+                cursor.execute("DELETE FROM usage_events WHERE ts < ? AND id <= (SELECT last_event_id FROM usage_rollup_state WHERE id = 1)",
+                               (now - USAGE_RAW_RETENTION_DAYS * 86400,))
+                cursor.execute("DELETE FROM usage_hourly WHERE bucket < ?", (now - USAGE_HOURLY_RETENTION_DAYS * 86400,))
+                cursor.execute("DELETE FROM usage_daily WHERE bucket < ?", (now - USAGE_DAILY_RETENTION_DAYS * 86400,))
+
+    def top(self, since, limit):
+        # Top keys, actions and IPs since an epoch. Hourly rollups cover their retention,
+        # daily rollups anything older.
+        self.flush()
+        self.rollup()
+        table, width = ("usage_hourly", 3600) if since >= time.time() - USAGE_HOURLY_RETENTION_DAYS * 86400 else ("usage_daily", 86400)
+        bucket = since - since % width
+        result = {}
+        with db_cursor() as cursor:
+            cursor.execute(f"SELECT COALESCE(SUM(count), 0) FROM {table} WHERE bucket >= ?", (bucket,))
+            result["total"] = cursor.fetchone()[0]
+            for column in ("key", "action", "ip"):
+                cursor.execute(f"SELECT {column}, SUM(count) AS total FROM {table} WHERE bucket >= ? GROUP BY {column} ORDER BY total DESC LIMIT ?",
+                               (bucket, limit))
+                result[column] = cursor.fetchall()
+        return result
+
+    def daily(self, key, days):
+        # Per-day, per-action counts for one key
+        self.flush()
+        self.rollup()
+        since = int(time.time()) - days * 86400
+        with db_cursor() as cursor:
+            cursor.execute("SELECT bucket, action, SUM(count) FROM usage_daily WHERE key = ? AND bucket >= ? GROUP BY bucket, action ORDER BY bucket DESC, action",
+                           (key, since - since % 86400))
+            return cursor.fetchall()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": len(self._events),
+                "recorded": self.recorded,
+                "dropped": self.dropped,
+                "written": self.written
+            }
+
+usage_recorder = UsageRecorder(USAGE_BUFFER_SIZE, USAGE_BATCH_SIZE)
+
+# Admin audit journal. Admin actions append entries to a buffer that a writer thread
+# inserts in batches into audit_log; triggers keep the table append-only.
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", 1))
+
+# Key row as a JSON-friendly dict with readable timestamps
+def key_snapshot(row):
+    snapshot = dict(zip(["key", "user_id", "expiration", "status", "registration_date", "android_uid"], row))
+    snapshot["expiration"] = epoch_to_iso(snapshot["expiration"])
+    snapshot["registration_date"] = epoch_to_iso(snapshot["registration_date"])
+    return snapshot
+
+class AuditLog:
+    def __init__(self):
+        self._entries = deque()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._thread = None
+
+    def record(self, actor, action, target_key=None, target_user=None, before=None, after=None):
+        entry = (int(time.time()), str(actor.id), str(actor), action, target_key,
+                 str(target_user) if target_user is not None else None,
+                 json.dumps(before) if before is not None else None,
+                 json.dumps(after) if after is not None else None)
+        with self._lock:
+            self._entries.append(entry)
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(AUDIT_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Audit writer error: {e}")
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                batch = list(self._entries)
+                self._entries.clear()
+            if not batch:
+                return
+            try:
+                with db_cursor() as cursor:
+                    cursor.executemany("INSERT INTO audit_log (ts, actor_id, actor_name, action, target_key, target_user, before, after) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                       batch)
+            except sqlite3.Error:
+                # Audit entries are never dropped; keep them for the next flush
+                with self._lock:
+                    self._entries.extendleft(reversed(batch))
+                raise
+
+    def history(self, target, limit):
+        # Newest first; target is a key or a Discord user ID
+        self.flush()
+        with db_cursor() as cursor:
+            cursor.execute('''SELECT ts, actor_id, actor_name, action, target_key, target_user, before, after FROM audit_log
+                WHERE target_key = ? OR target_user = ? ORDER BY ts DESC, id DESC LIMIT ?''', (target, target, limit))
+            return cursor.fetchall()
+
+audit_log = AuditLog()
 
 # Admin role, Guild, and VIP role IDs
 ADMIN_ROLE_ID = "1305384766459215893"
 GUILD_ID = "1305375757681561640"
 VIP_ROLE_ID = "1352820677224431737"
 
+# Registry of the guild and its channels, categories and roles. Names are resolved
+# once and then routed by ID; the name -> ID bindings are persisted so renames don't
+# break routing, and the gateway channel events keep them current.
+REGISTRY_CHANNELS = ["admin", "buy-hack-ticket", "logs", "keys"]
+REGISTRY_CATEGORIES = ["ZLI Management", "Tickets"]
+
+class GuildRegistry:
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.guild = None
+        self._ids = {}  # (kind, name) -> channel/category ID
+
+    def load(self):
+        with db_cursor() as cursor:
+            cursor.execute("SELECT kind, name, object_id FROM guild_registry")
+            self._ids = {(kind, name): object_id for kind, name, object_id in cursor}
+
+    def bind(self, guild):
+        # Persisted IDs win; names are only used for bindings that are missing or stale
+        self.guild = guild
+        for kind, names, pool in (("channel", REGISTRY_CHANNELS, guild.text_channels),
+                                  ("category", REGISTRY_CATEGORIES, guild.categories)):
+            for name in names:
+                if not self._get(kind, name):
+                    self.register(kind, name, discord.utils.get(pool, name=name))
+
+    def register(self, kind, name, obj):
+        object_id = obj.id if obj else None
+        if self._ids.get((kind, name)) == object_id:
+            return
+        with db_cursor() as cursor:
+            if object_id is None:
+                cursor.execute("DELETE FROM guild_registry WHERE kind = ? AND name = ?", (kind, name))
+            else:
+                cursor.execute("INSERT OR REPLACE INTO guild_registry (kind, name, object_id) VALUES (?, ?, ?)",
+                               (kind, name, object_id))
+        if object_id is None:
+            self._ids.pop((kind, name), None)
+        else:
+            self._ids[(kind, name)] = object_id
+
+    def _get(self, kind, name):
+        guild = self.guild
+        object_id = self._ids.get((kind, name))
+        if guild is None or object_id is None:
+            return None
+        return guild.get_channel(object_id)
+
+    def channel(self, name):
+        return self._get("channel", name)
+
+    def category(self, name):
+        return self._get("category", name)
+
+    def role(self, role_id):
+        return self.guild.get_role(int(role_id)) if self.guild else None
+
+    def channel_created(self, channel):
+        if isinstance(channel, discord.CategoryChannel):
+            kind, names = "category", REGISTRY_CATEGORIES
+        else:
+            kind, names = "channel", REGISTRY_CHANNELS
+        if channel.name in names and not self._get(kind, channel.name):
+            self.register(kind, channel.name, channel)
+
+    def channel_deleted(self, channel):
+        for (kind, name), object_id in list(self._ids.items()):
+            if object_id == channel.id:
+                # Fall back to another channel with the same name, if there is one
+                pool = self.guild.categories if kind == "category" else self.guild.text_channels
+                self.register(kind, name, discord.utils.find(lambda c: c.name == name and c.id != channel.id, pool))
+
+registry = GuildRegistry(int(GUILD_ID))
+registry.load()
+
+# VIP role reconciler. The desired VIP set is every user with an active, registered
+# key; it is diffed against the role's cached members and the changes are applied one
+# at a time by a worker that retries failures and waits out rate limits.
+VIP_RECONCILE_MINUTES = float(os.getenv("VIP_RECONCILE_MINUTES", 30))
+VIP_ROLE_OP_DELAY = float(os.getenv("VIP_ROLE_OP_DELAY", 0.25))
+VIP_ROLE_OP_RETRIES = int(os.getenv("VIP_ROLE_OP_RETRIES", 3))
+
+class VipReconciler:
+    def __init__(self):
+        self._loop = None
+        self._queue = None
+        self._queued = {}  # user_id -> (add, reason) waiting in the queue
+        self._task = None
+        self.applied = 0
+        self.failed = 0
+
+    def is_running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._task = self._loop.create_task(self._worker())
+
+    def pending(self):
+        return len(self._queued)
+
+    def ready(self):
+        return self._queue is not None and registry.role(VIP_ROLE_ID) is not None
+
+    def request(self, user_ids, reason=""):
+        # Reconcile specific users soon; safe to call from any thread
+        if self._loop:
+            asyncio.run_coroutine_threadsafe(self.reconcile(user_ids, reason), self._loop)
+
+    def _desired(self, user_ids):
+        query = "SELECT DISTINCT user_id FROM keys WHERE status = 'active' AND android_uid IS NOT NULL AND user_id IS NOT NULL"
+        params = ()
+        if user_ids is not None:
+            query += " AND user_id IN (SELECT value FROM json_each(?))"
+            params = (json.dumps(list(user_ids)),)
+        with db_cursor() as cursor:
+            cursor.execute(query, params)
+            return {row[0] for row in cursor if not ban_list.is_banned(row[0])}
+
+    async def reconcile(self, user_ids=None, reason=""):
+        # Queue the changes needed for the given users (or everyone); returns (added, removed)
+        guild = registry.guild
+        vip_role = registry.role(VIP_ROLE_ID)
+        if not vip_role or self._queue is None:
+            return 0, 0
+        if user_ids is not None:
+            user_ids = {str(user_id) for user_id in user_ids}
+        desired = await asyncio.to_thread(self._desired, user_ids)
+        current = {str(member.id) for member in vip_role.members}
+        if user_ids is not None:
+            current &= user_ids
+        to_add = [user_id for user_id in desired - current if user_id.isdigit() and guild.get_member(int(user_id))]
+        to_remove = current - desired
+        for user_id in to_add:
+            self._enqueue(user_id, True, reason)
+        for user_id in to_remove:
+            self._enqueue(user_id, False, reason)
+        return len(to_add), len(to_remove)
+
+    def _enqueue(self, user_id, add, reason):
+        queued = user_id in self._queued
+        self._queued[user_id] = (add, reason)
+        if not queued:
+            self._queue.put_nowait(user_id)
+
+    async def _worker(self):
+        while True:
+            user_id = await self._queue.get()
+            add, reason = self._queued.pop(user_id, (None, ""))
+            if add is not None:
+                await self._apply(user_id, add, reason)
+                await asyncio.sleep(VIP_ROLE_OP_DELAY)
+
+    async def _apply(self, user_id, add, reason):
+        for attempt in range(VIP_ROLE_OP_RETRIES):
+            guild = registry.guild
+            member = guild.get_member(int(user_id)) if guild else None
+            vip_role = registry.role(VIP_ROLE_ID)
+            if not member or not vip_role or (vip_role in member.roles) == add:
+                return
+            try:
+                if add:
+                    await member.add_roles(vip_role)
+                else:
+                    await member.remove_roles(vip_role)
+            except discord.NotFound:
+                return
+            except discord.HTTPException as e:
+                retry_after = float(e.response.headers.get("Retry-After", 0) or 0) if e.status == 429 else 0
+                await asyncio.sleep(max(retry_after, 2 ** attempt))
+                continue
+            self.applied += 1
+            log_sink.log(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] VIP role {'added to' if add else 'removed from'} user {user_id} {reason}".rstrip())
+            return
+        self.failed += 1
+        print(f"Failed to {'add' if add else 'remove'} VIP role for user {user_id}")
+
+vip_reconciler = VipReconciler()
+
+# Discord side effects of API requests (log lines, VIP grants). With the bot in the
+# same process they go straight to the log sink and the reconciler. A PROCESS_ROLE=api
+# process inserts them into the outbox table, inside the caller's transaction when it
+# passes its cursor, so they survive a crash once the request has been answered. The
+# table keeps at most OUTBOX_MAX_ROWS recent log lines; the bot process drains it,
+# deleting rows only once delivered and retrying failures with exponential backoff.
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 1))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 200))
+OUTBOX_MAX_BACKOFF = float(os.getenv("OUTBOX_MAX_BACKOFF", 300))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 20))
+OUTBOX_MAX_ROWS = int(os.getenv("OUTBOX_MAX_ROWS", 100000))
+
+class Outbox:
+    def __init__(self, max_rows, durable):
+        self.max_rows = max_rows
+        self.durable = durable
+        self._lock = threading.Lock()
+        self._task = None
+        self.dropped = 0
+        self.delivered = 0
+        self.failed = 0
+
+    # Producer side, safe from any thread
+    def log(self, line, cursor=None):
+        if not self.durable:
+            log_sink.log(line)
+            return
+        self._insert(cursor, "log", {"line": line[:DISCORD_MESSAGE_LIMIT]})
+
+    def request_vip(self, user_ids, reason="", cursor=None):
+        if not self.durable:
+            vip_reconciler.request(user_ids, reason)
+            return
+        self._insert(cursor, "vip", {"user_ids": [str(user_id) for user_id in user_ids], "reason": reason})
+
+    def _insert(self, cursor, kind, payload):
+        if cursor is None:
+            with db_cursor() as cursor:
+                return self._insert(cursor, kind, payload)
+        cursor.execute("INSERT INTO outbox (kind, payload, created_at) VALUES (?, ?, ?)",
+                       (kind, json.dumps(payload), int(time.time())))
+        # Keep the table bounded while the bot is away: log lines older than the last
+        # max_rows entries go first, VIP grants are kept
+        cursor.execute("DELETE FROM outbox WHERE kind = 'log' AND id <= ?", (cursor.lastrowid - self.max_rows,))
+        if cursor.rowcount > 0:
+            with self._lock:
+                self.dropped += cursor.rowcount
+
+    # Consumer side, on the bot loop
+    def is_running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._drain_loop())
+
+    async def _drain_loop(self):
+        while True:
+            try:
+                while await self.drain():
+                    pass
+            except Exception as e:
+                print(f"Outbox drain error: {e}")
+            await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+    def _due(self):
+        with db_cursor() as cursor:
+            cursor.execute("SELECT id, kind, payload, attempts FROM outbox WHERE next_attempt_at <= ? ORDER BY id LIMIT ?",
+                           (int(time.time()), OUTBOX_BATCH_SIZE))
+            return cursor.fetchall()
+
+    def _settle(self, delivered, retries):
+        now = int(time.time())
+        give_up = [row_id for row_id, attempts in retries if attempts + 1 >= OUTBOX_MAX_ATTEMPTS]
+        with db_cursor() as cursor:
+            cursor.executemany("DELETE FROM outbox WHERE id = ?", [(row_id,) for row_id in delivered + give_up])
+            cursor.executemany("UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ? WHERE id = ?",
+                               [(now + min(OUTBOX_MAX_BACKOFF, 2 ** attempts), row_id)
+                                for row_id, attempts in retries if attempts + 1 < OUTBOX_MAX_ATTEMPTS])
+        self.delivered += len(delivered)
+        self.failed += len(give_up)
+        if give_up:
+            print(f"Outbox gave up on {len(give_up)} entries after {OUTBOX_MAX_ATTEMPTS} attempts")
+
+    async def drain(self):
+        # Deliver one batch; returns True when a full batch was delivered
+        rows = await asyncio.to_thread(self._due)
+        if not rows:
+            return False
+        delivered, retries = [], []
+        logs = [(row_id, json.loads(payload)["line"], attempts) for row_id, kind, payload, attempts in rows if kind == "log"]
+        vips = [(row_id, json.loads(payload), attempts) for row_id, kind, payload, attempts in rows if kind == "vip"]
+
+        # Pack log lines into as few messages as fit the Discord limit
+        log_channel = registry.channel("logs")
+        message, message_rows = "", []
+        for i, (row_id, line, attempts) in enumerate(logs):
+            message_rows.append((row_id, attempts))
+            message += ("\n" if len(message_rows) > 1 else "") + line
+            if i + 1 < len(logs) and len(message) + len(logs[i + 1][1]) + 1 <= DISCORD_MESSAGE_LIMIT:
+                continue
+            try:
+                if not log_channel:
+                    raise RuntimeError("logs channel not available")
+                await log_channel.send(message)
+                delivered += [row_id for row_id, _ in message_rows]
+            except (discord.HTTPException, RuntimeError) as e:
+                print(f"Outbox failed to send logs: {e}")
+                retries += message_rows
+            message, message_rows = "", []
+
+        for row_id, payload, attempts in vips:
+            if not vip_reconciler.ready():
+                retries.append((row_id, attempts))
+                continue
+            try:
+                await vip_reconciler.reconcile(payload["user_ids"], payload["reason"])
+                delivered.append(row_id)
+            except Exception as e:
+                print(f"Outbox failed to reconcile VIP roles: {e}")
+                retries.append((row_id, attempts))
+
+        await asyncio.to_thread(self._settle, delivered, retries)
+        return len(rows) == OUTBOX_BATCH_SIZE and not retries
+
+    def stats(self):
+        with db_cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM outbox")
+            depth = cursor.fetchone()[0]
+        with self._lock:
+            return {
+                "depth": depth,
+                "dropped": self.dropped,
+                "delivered": self.delivered,
+                "failed": self.failed
+            }
+
+outbox = Outbox(OUTBOX_MAX_ROWS, PROCESS_ROLE == "api")
+
+# Applies cache changes published by other processes (split deployments only) and
+# prunes old sync events
+PROCESS_SYNC_INTERVAL = float(os.getenv("PROCESS_SYNC_INTERVAL", 1))
+SYNC_EVENT_RETENTION = int(os.getenv("SYNC_EVENT_RETENTION", 3600))
+
+class ProcessSync:
+    def __init__(self):
+        self._thread = None
+        self._last_id = 0
+        self._last_prune = 0
+
+    def start(self):
+        with db_cursor() as cursor:
+            cursor.execute("SELECT COALESCE(MAX(id), 0) FROM sync_events")
+            self._last_id = cursor.fetchone()[0]
+        self._thread = threading.Thread(target=self._run, name="process-sync", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(PROCESS_SYNC_INTERVAL)
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Process sync error: {e}")
+
+    def poll(self):
+        with db_cursor() as cursor:
+            cursor.execute("SELECT id, kind, value FROM sync_events WHERE id > ? ORDER BY id", (self._last_id,))
+            events = cursor.fetchall()
+            if time.time() - self._last_prune >= SYNC_EVENT_RETENTION / 10:
+                cursor.execute("DELETE FROM sync_events WHERE created_at < ?", (int(time.time()) - SYNC_EVENT_RETENTION,))
+                self._last_prune = time.time()
+        if not events:
+            return
+        self._last_id = events[-1][0]
+        keys = [value for _, kind, value in events if kind == "key"]
+        if keys:
+            key_cache.invalidate(*keys, publish=False)
+        banned = [value for _, kind, value in events if kind == "ban"]
+        unbanned = [value for _, kind, value in events if kind == "unban"]
+        if banned or unbanned:
+            ban_list.apply(banned, unbanned)
+        if any(kind == "maintenance" for _, kind, _ in events):
+            maintenance_state.load()
+
+process_sync = ProcessSync()
+
 # Flask application for API
 app = Flask(__name__)
 CORS(app)
 
+# API server mode: "waitress" (production WSGI server) or "dev" (Werkzeug dev server)
+API_SERVER = os.getenv("API_SERVER", "waitress")
+API_HOST = os.getenv("API_HOST", "0.0.0.0")
+API_THREADS = int(os.getenv("API_THREADS", 16))
+API_CONNECTION_LIMIT = int(os.getenv("API_CONNECTION_LIMIT", 1000))
+API_KEEPALIVE_TIMEOUT = int(os.getenv("API_KEEPALIVE_TIMEOUT", 120))
+API_PROCESSES = int(os.getenv("API_PROCESSES", 1))  # PROCESS_ROLE=api with waitress only
+
+# Per-route request metrics
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def remember_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+# Teardown also runs when a view raises, so unhandled errors are counted as 500s
+@app.teardown_request
+def record_request_metrics(exc=None):
+    start = g.pop("request_start", None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        status = 500 if exc is not None else g.pop("response_status", 500)
+        http_request_seconds.observe(time.perf_counter() - start, route=route)
+        http_requests_total.inc(route=route, method=request.method, status=status)
+
+# Token-bucket rate limiting per client IP and per key. Limits are (tokens per second,
+# burst) per route and scope; RATE_LIMITS (JSON) overrides them, e.g.
+# {"/check_key": {"ip": [10, 30], "key": [2, 10]}}. Requests over the limit get a 429
+# before they reach SQLite or Discord.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_MAX_BUCKETS = int(os.getenv("RATE_LIMIT_MAX_BUCKETS", 100000))
+RATE_LIMITS = {
+    "/check_maintenance": {"ip": (5, 20)},
+    "/wait_maintenance": {"ip": (1, 5)},
+    "/check_key": {"ip": (10, 30), "key": (2, 10)},
+    "/check_uid": {"ip": (10, 30), "key": (2, 10)},
+    "/check_keys": {"ip": (1, 5)},
+    "/register_uid": {"ip": (1, 5), "key": (0.2, 3)},
+    "/license_token": {"ip": (2, 10), "key": (0.1, 5)},
+    "/token_revocations": {"ip": (1, 10)},
+    "/log_usage": {"ip": (5, 20), "key": (2, 10)},
+    "/script_execution": {"ip": (5, 20), "key": (2, 10)},
+}
+for route, scopes in json.loads(os.getenv("RATE_LIMITS", "{}")).items():
+    RATE_LIMITS[route] = {scope: tuple(limit) for scope, limit in scopes.items()}
+    for scope, (rate, burst) in RATE_LIMITS[route].items():
+        if rate <= 0 or burst < 1:
+            raise ValueError(f"RATE_LIMITS {route} {scope}: rate must be > 0 and burst >= 1")
+
+class RateLimiter:
+    def __init__(self, max_buckets):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()  # (route, scope, id) -> [tokens, last refill]
+        self._lock = threading.Lock()
+        # A bucket idle this long has refilled completely and can be forgotten
+        self.idle_ttl = max((burst / rate for scopes in RATE_LIMITS.values() for rate, burst in scopes.values()), default=0)
+
+    def acquire(self, limits):
+        # Take one token from every (bucket_id, rate, burst) bucket, or from none of them
+        # if any is empty. Returns (0, None) when allowed, otherwise the seconds until the
+        # request could pass and the first bucket that refused it.
+        now = time.monotonic()
+        with self._lock:
+            buckets = []
+            for bucket_id, rate, burst in limits:
+                bucket = self._buckets.get(bucket_id)
+                if bucket is None:
+                    bucket = self._buckets[bucket_id] = [burst, now]
+                else:
+                    bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                    bucket[1] = now
+                    self._buckets.move_to_end(bucket_id)
+                buckets.append((bucket_id, rate, bucket))
+            self._expire(now)
+            refused = [(bucket_id, (1 - bucket[0]) / rate) for bucket_id, rate, bucket in buckets if bucket[0] < 1]
+            if refused:
+                return max(wait for _, wait in refused), refused[0][0]
+            for _, _, bucket in buckets:
+                bucket[0] -= 1
+            return 0, None
+
+    def _expire(self, now):
+        # Oldest-first: drop fully refilled buckets, then evict beyond the size cap
+        while self._buckets:
+            oldest = next(iter(self._buckets.values()))
+            if now - oldest[1] < self.idle_ttl and len(self._buckets) <= self.max_buckets:
+                break
+            self._buckets.popitem(last=False)
+
+    def __len__(self):
+        return len(self._buckets)
+
+rate_limiter = RateLimiter(RATE_LIMIT_MAX_BUCKETS)
+
+# JSON bodies may carry IDs and keys as numbers, while the tables, the ban list and
+# the key cache are keyed by text; other types count as missing
+def json_text(data, name):
+    value = data.get(name) if isinstance(data, dict) else None
+    if isinstance(value, bool) or not isinstance(value, (str, int)):
+        return None
+    return str(value)
+
+def request_key():
+    key = request.args.get('key')
+    if key is None and request.method == 'POST':
+        key = json_text(request.get_json(silent=True), 'key')
+    return key
+
+@app.before_request
+def enforce_rate_limits():
+    if not RATE_LIMIT_ENABLED or not request.url_rule:
+        return None
+    route = request.url_rule.rule
+    limits = RATE_LIMITS.get(route)
+    if not limits:
+        return None
+    # Charge every scope together, so a request refused for its key doesn't also
+    # spend the IP's tokens
+    buckets = []
+    for scope in ("ip", "key"):
+        if scope not in limits:
+            continue
+        client_id = request.remote_addr if scope == "ip" else request_key()
+        if not client_id:
+            continue
+        rate, burst = limits[scope]
+        buckets.append(((route, scope, client_id), rate, burst))
+    retry_after, refused = rate_limiter.acquire(buckets)
+    if retry_after:
+        rate_limited_total.inc(route=route, scope=refused[1])
+        response = jsonify({"error": "Too many requests"})
+        response.status_code = 429
+        response.headers["Retry-After"] = str(max(1, int(retry_after + 0.999)))
+        return response
+    return None
+
 # Function to check maintenance status
 def is_maintenance_active():
-    cursor.execute("SELECT active, end_time FROM maintenance WHERE id = 1")
-    row = cursor.fetchone()
-    if not row:
-        return False
-    active, end_time = row
-    if not active or not end_time:
-        return False
-    end_time = datetime.fromisoformat(end_time)
-    return active and datetime.now() < end_time
+    return maintenance_state.is_active()
+
+# Maintenance status supports conditional GETs; clients can also long-poll
+# /wait_maintenance with If-None-Match to be told about changes as they happen
+MAINTENANCE_MAX_AGE = int(os.getenv("MAINTENANCE_MAX_AGE", 5))
+MAINTENANCE_WAIT_TIMEOUT = float(os.getenv("MAINTENANCE_WAIT_TIMEOUT", 30))
+MAINTENANCE_MAX_WAITERS = int(os.getenv("MAINTENANCE_MAX_WAITERS", max(1, API_THREADS // 2)))
+maintenance_waiters = threading.BoundedSemaphore(MAINTENANCE_MAX_WAITERS)
+
+def maintenance_response(etag):
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = jsonify(maintenance_state.status())
+    response.set_etag(etag)
+    max_age = MAINTENANCE_MAX_AGE
+    if maintenance_state.is_active():
+        max_age = min(max_age, int(maintenance_state.seconds_left()))
+    response.headers["Cache-Control"] = f"max-age={max_age}"
+    return response
 
 # Route to check maintenance status
 @app.route('/check_maintenance', methods=['GET'])
 def check_maintenance():
-    cursor.execute("SELECT active, end_time FROM maintenance WHERE id = 1")
-    row = cursor.fetchone()
-    if not row:
-        return jsonify({"active": False, "end_time": None}), 200
-    active, end_time = row
-    if not active or not end_time:
-        return jsonify({"active": False, "end_time": None}), 200
-    end_time_dt = datetime.fromisoformat(end_time)
-    if datetime.now() > end_time_dt:
-        cursor.execute("UPDATE maintenance SET active = ?, end_time = ? WHERE id = ?", (False, None, 1))
-        db.commit()
-        return jsonify({"active": False, "end_time": None}), 200
-    return jsonify({"active": True, "end_time": end_time}), 200
+    return maintenance_response(maintenance_state.etag())
+
+# Long-poll: answers at once if the client's ETag is stale, otherwise waits up to
+# ?timeout= seconds for a change and returns 304 if nothing happened. When every
+# waiter slot is taken it returns 503 with Retry-After so clients back off instead
+# of re-polling in a tight loop.
+@app.route('/wait_maintenance', methods=['GET'])
+def wait_maintenance():
+    timeout = min(request.args.get('timeout', MAINTENANCE_WAIT_TIMEOUT, type=float), MAINTENANCE_WAIT_TIMEOUT)
+    etag = maintenance_state.etag()
+    if etag in request.if_none_match and timeout > 0:
+        # Don't let idle waiters take every API worker thread
+        if not maintenance_waiters.acquire(blocking=False):
+            response = jsonify({"error": "Too many waiters"})
+            response.status_code = 503
+            response.headers["Retry-After"] = str(max(1, MAINTENANCE_MAX_AGE))
+            response.set_etag(etag)
+            return response
+        try:
+            maintenance_state.wait(etag, timeout)
+        finally:
+            maintenance_waiters.release()
+        etag = maintenance_state.etag()
+    return maintenance_response(etag)
 
 @app.route('/check_key', methods=['GET'])
 def check_key():
     if is_maintenance_active():
         return jsonify({"error": "Server under maintenance"}), 503
     key = request.args.get('key')
-    cursor.execute("SELECT * FROM keys WHERE key = ?", (key,))
-    row = cursor.fetchone()
+    row = key_cache.get(key)
     if row:
         return jsonify({
             "key": row[0],
             "user_id": row[1],
-            "expiration": row[2],
+            "expiration": epoch_to_iso(row[2]),
             "status": row[3],
-            "registration_date": row[4]
+            "registration_date": epoch_to_iso(row[4])
         })
     return jsonify({"error": "Invalid key"}), 404
 
@@ -121,18 +1574,77 @@ def check_uid():
     if not key or not android_uid:
         return jsonify({"error": "Invalid request"}), 400
 
-    cursor.execute("SELECT android_uid FROM keys WHERE key = ?", (key,))
-    row = cursor.fetchone()
+    row = key_cache.get(key)
     if not row:
         return jsonify({"error": "Invalid key"}), 404
     
-    if row[0]:
-        registered_uid = row[0]
+    if row[5]:
+        registered_uid = row[5]
         if registered_uid != android_uid:
             return jsonify({"error": "Key already in use"}), 403
         return jsonify({"exists": True}), 200
     return jsonify({"exists": False}), 200
 
+# Bulk key validation settings
+BULK_CHECK_MAX_KEYS = int(os.getenv("BULK_CHECK_MAX_KEYS", 1000))
+BULK_CHECK_STREAM_THRESHOLD = int(os.getenv("BULK_CHECK_STREAM_THRESHOLD", 200))
+
+# Per-key result with the same fields /check_key and /check_uid return
+def bulk_check_result(key, android_uid, row):
+    if not row:
+        return {"key": key, "error": "Invalid key"}
+    result = {
+        "key": row[0],
+        "user_id": row[1],
+        "expiration": epoch_to_iso(row[2]),
+        "status": row[3],
+        "registration_date": epoch_to_iso(row[4])
+    }
+    if android_uid:
+        if row[5] and row[5] != android_uid:
+            result["uid"] = {"error": "Key already in use"}
+        else:
+            result["uid"] = {"exists": bool(row[5])}
+    return result
+
+@app.route('/check_keys', methods=['POST'])
+def check_keys():
+    if is_maintenance_active():
+        return jsonify({"error": "Server under maintenance"}), 503
+    data = request.get_json(silent=True)
+    items = data.get('keys') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Invalid request"}), 400
+    if len(items) > BULK_CHECK_MAX_KEYS:
+        return jsonify({"error": f"Too many keys (max {BULK_CHECK_MAX_KEYS})"}), 413
+
+    # Accept plain keys or {"key": ..., "android_uid": ...} objects
+    requests_list = []
+    for item in items:
+        if isinstance(item, str):
+            requests_list.append((item, None))
+        elif isinstance(item, dict) and isinstance(item.get('key'), str):
+            requests_list.append((item['key'], item.get('android_uid')))
+        else:
+            return jsonify({"error": "Invalid request"}), 400
+
+    # Resolve the whole batch with one query
+    unique_keys = list(dict.fromkeys(key for key, _ in requests_list))
+    with db_cursor() as cursor:
+        cursor.execute("SELECT keys.* FROM keys JOIN json_each(?) AS batch ON keys.key = batch.value",
+                       (json.dumps(unique_keys),))
+        rows = {row[0]: row for row in cursor}
+
+    if len(requests_list) <= BULK_CHECK_STREAM_THRESHOLD:
+        return jsonify({"results": [bulk_check_result(key, uid, rows.get(key)) for key, uid in requests_list]}), 200
+
+    def generate():
+        yield '{"results":['
+        for i, (key, uid) in enumerate(requests_list):
+            yield ("," if i else "") + json.dumps(bulk_check_result(key, uid, rows.get(key)))
+        yield ']}'
+    return Response(generate(), mimetype='application/json'), 200
+
 @app.route('/register_uid', methods=['GET', 'POST'])
 def register_uid():
     if is_maintenance_active():
@@ -142,9 +1654,9 @@ def register_uid():
             data = request.get_json()
             if not data:
                 return jsonify({"error": "Invalid request"}), 400
-            key = data.get('key')
-            discord_id = data.get('discord_id')
-            android_uid = data.get('android_uid')
+            key = json_text(data, 'key')
+            discord_id = json_text(data, 'discord_id')
+            android_uid = json_text(data, 'android_uid')
         else:  # GET
             key = request.args.get('key')
             discord_id = request.args.get('discord_id')
@@ -154,37 +1666,161 @@ def register_uid():
             return jsonify({"error": "Invalid request"}), 400
         
         # Check if user is banned
-        cursor.execute("SELECT * FROM banned_users WHERE user_id = ?", (discord_id,))
-        if cursor.fetchone():
+        if ban_list.is_banned(discord_id):
             return jsonify({"error": "Access denied"}), 403
 
-        cursor.execute("SELECT user_id FROM keys WHERE key = ?", (key,))
-        row = cursor.fetchone()
+        row = key_cache.get(key)
         if not row:
             return jsonify({"error": "Invalid key"}), 404
-        
-        cursor.execute("UPDATE keys SET android_uid = ?, user_id = ? WHERE key = ?",
-                       (android_uid, discord_id, key))
-        db.commit()
-        
-        log_channel = discord.utils.get(bot.get_guild(int(GUILD_ID)).channels, name="logs")
-        if log_channel:
-            ip_address = request.remote_addr
-            bot.loop.create_task(log_channel.send(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] User {discord_id} registered UID with key {key} | IP: {ip_address}"))
-        
+
+        ip_address = request.remote_addr
+        line = f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] User {discord_id} registered UID with key {key} | IP: {ip_address}"
+        with db_cursor() as cursor:
+            cursor.execute("UPDATE keys SET android_uid = ?, user_id = ? WHERE key = ?",
+                           (android_uid, discord_id, key))
+            # Tokens issued to the previous device stop being valid
+            if row[5] and (row[5] != android_uid or row[1] != discord_id):
+                record_revocations(cursor, [key])
+            # Split deployments commit the log line and VIP grant with the registration
+            if outbox.durable:
+                outbox.log(line, cursor)
+                outbox.request_vip([discord_id], f"| IP: {ip_address}", cursor)
+        key_cache.invalidate(key)
+
         # Add VIP role to user
-        guild = bot.get_guild(int(GUILD_ID))
-        member = guild.get_member(int(discord_id))
-        if member:
-            vip_role = guild.get_role(int(VIP_ROLE_ID))
-            if vip_role and vip_role not in member.roles:
-                bot.loop.create_task(member.add_roles(vip_role))
-                bot.loop.create_task(log_channel.send(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] VIP role added to user {discord_id} | IP: {ip_address}"))
+        if not outbox.durable:
+            outbox.log(line)
+            outbox.request_vip([discord_id], f"| IP: {ip_address}")
 
         return jsonify({"success": "UID registered"}), 200
     except Exception as e:
         return jsonify({"error": "Server error"}), 500
 
+# Signed license tokens. A token is base64url(JSON claims) + "." + base64url(Ed25519
+# signature of the first part). LICENSE_SIGNING_KEY is the base64 32-byte private key
+# seed; clients only ever hold the public key from /license_public_key, so they can
+# verify tokens offline but not mint them. Claims: k (key), u (android_uid),
+# d (Discord user ID), e (key expiration), iat, exp (token expiry) and v (revocation
+# version at issue time) and r (revocation ID). Clients refresh after refresh_after and
+# poll /token_revocations?since=v, dropping their token when its r is listed. The feed
+# is public, so it carries keyed hashes of revoked keys, never the keys themselves.
+LICENSE_SIGNING_KEY = os.getenv("LICENSE_SIGNING_KEY", "")
+LICENSE_TOKEN_TTL = int(os.getenv("LICENSE_TOKEN_TTL", 86400))
+LICENSE_TOKEN_REFRESH = int(os.getenv("LICENSE_TOKEN_REFRESH", 3600))
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def load_signing_key(encoded):
+    if not encoded:
+        return None
+    seed = base64.urlsafe_b64decode(encoded.replace("+", "-").replace("/", "_") + "=" * (-len(encoded) % 4))
+    if len(seed) != 32:
+        raise ValueError("LICENSE_SIGNING_KEY must be a base64 32-byte Ed25519 seed")
+    return Ed25519PrivateKey.from_private_bytes(seed)
+
+license_signing_key = load_signing_key(LICENSE_SIGNING_KEY)
+# Secret for revocation IDs, derived from the signing key so it needs no extra setting
+license_revocation_secret = hashlib.sha256(
+    b"license-revocation:" + license_signing_key.private_bytes(Encoding.Raw, PrivateFormat.Raw, NoEncryption())
+).digest() if license_signing_key else None
+
+def revocation_id(key):
+    # Keyed, so short keys can't be recovered by hashing every candidate
+    return b64url(hmac.new(license_revocation_secret, key.encode(), hashlib.sha256).digest()[:16])
+
+def license_public_key_b64():
+    return b64url(license_signing_key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw))
+
+def sign_license_token(claims):
+    payload = b64url(json.dumps(claims, separators=(",", ":"), sort_keys=True).encode())
+    return f"{payload}.{b64url(license_signing_key.sign(payload.encode()))}"
+
+# Record revoked keys inside the caller's transaction and prune entries older than
+# any token that could still be valid
+def record_revocations(cursor, keys):
+    if not keys:
+        return
+    now = int(time.time())
+    cursor.executemany("INSERT INTO license_revocations (key, revoked_at) VALUES (?, ?)", [(key, now) for key in keys])
+    cursor.execute("DELETE FROM license_revocations WHERE revoked_at < ?", (now - LICENSE_TOKEN_TTL,))
+
+def revocation_version(cursor):
+    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'license_revocations'")
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+@app.route('/license_token', methods=['GET', 'POST'])
+def license_token():
+    if is_maintenance_active():
+        return jsonify({"error": "Server under maintenance"}), 503
+    if not license_signing_key:
+        return jsonify({"error": "Tokens not available"}), 503
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        key = json_text(data, 'key')
+        android_uid = json_text(data, 'android_uid')
+    else:  # GET
+        key = request.args.get('key')
+        android_uid = request.args.get('android_uid')
+
+    if not key or not android_uid:
+        return jsonify({"error": "Invalid request"}), 400
+
+    row = key_cache.get(key)
+    now = int(time.time())
+    if not row or row[3] != 'active' or (row[2] is not None and row[2] <= now):
+        return jsonify({"error": "Invalid key"}), 404
+    if row[5] != android_uid:
+        return jsonify({"error": "Key not registered to this device"}), 403
+    if ban_list.is_banned(row[1]):
+        return jsonify({"error": "Access denied"}), 403
+
+    with db_cursor() as cursor:
+        version = revocation_version(cursor)
+    # Token claims are whole seconds, rounded down so a token never outlives its key
+    key_expiration = int(row[2]) if row[2] is not None else None
+    expires_at = now + LICENSE_TOKEN_TTL
+    if key_expiration is not None:
+        expires_at = min(expires_at, key_expiration)
+    token = sign_license_token({
+        "k": key,
+        "u": android_uid,
+        "d": row[1],
+        "e": key_expiration,
+        "iat": now,
+        "exp": expires_at,
+        "v": version,
+        "r": revocation_id(key)
+    })
+    return jsonify({
+        "token": token,
+        "expires_at": epoch_to_iso(expires_at),
+        "refresh_after": epoch_to_iso(max(now, expires_at - LICENSE_TOKEN_REFRESH))
+    }), 200
+
+@app.route('/license_public_key', methods=['GET'])
+def license_public_key():
+    if not license_signing_key:
+        return jsonify({"error": "Tokens not available"}), 503
+    return jsonify({"alg": "Ed25519", "public_key": license_public_key_b64()}), 200
+
+# Revocation IDs of keys revoked after a given version; the version doubles as the ETag
+@app.route('/token_revocations', methods=['GET'])
+def token_revocations():
+    if not license_signing_key:
+        return jsonify({"error": "Tokens not available"}), 503
+    since = request.args.get('since', 0, type=int)
+    with db_cursor() as cursor:
+        version = revocation_version(cursor)
+        if request.if_none_match.contains(str(version)):
+            response = Response(status=304)
+        else:
+            cursor.execute("SELECT DISTINCT key FROM license_revocations WHERE version > ?", (since,))
+            response = jsonify({"version": version, "ids": [revocation_id(row[0]) for row in cursor]})
+    response.set_etag(str(version))
+    return response
+
 @app.route('/log_usage', methods=['GET', 'POST'])
 def log_usage():
     if is_maintenance_active():
@@ -194,8 +1830,8 @@ def log_usage():
             data = request.get_json()
             if not data:
                 return jsonify({"error": "Invalid request"}), 400
-            key = data.get('key')
-            action = data.get('action')
+            key = json_text(data, 'key')
+            action = json_text(data, 'action')
         else:  # GET
             key = request.args.get('key')
             action = request.args.get('action')
@@ -203,14 +1839,12 @@ def log_usage():
         if not key or not action:
             return jsonify({"error": "Invalid request"}), 400
         
-        cursor.execute("SELECT user_id FROM keys WHERE key = ?", (key,))
-        row = cursor.fetchone()
-        discord_id = row[0] if row else "Unknown"
-
-        log_channel = discord.utils.get(bot.get_guild(int(GUILD_ID)).channels, name="logs")
-        if log_channel:
-            ip_address = request.remote_addr
-            bot.loop.create_task(log_channel.send(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Key `{key}` used action: {action} | Discord ID: {discord_id} | IP: {ip_address}"))
+        row = key_cache.get(key)
+        discord_id = row[1] if row else "Unknown"
+
+        ip_address = request.remote_addr
+        outbox.log(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Key `{key}` used action: {action} | Discord ID: {discord_id} | IP: {ip_address}")
+        usage_recorder.record(key, row[1] if row else None, action, ip_address)
         
         return jsonify({"success": "Logged"}), 200
     except Exception as e:
@@ -225,35 +1859,238 @@ def script_execution():
             data = request.get_json()
             if not data:
                 return jsonify({"error": "Invalid request"}), 400
-            key = data.get('key')
+            key = json_text(data, 'key')
         else:  # GET
             key = request.args.get('key')
         
         if not key:
             return jsonify({"error": "Invalid request"}), 400
         
-        cursor.execute("SELECT user_id FROM keys WHERE key = ?", (key,))
-        row = cursor.fetchone()
-        discord_id = row[0] if row else "Unknown"
-
-        log_channel = discord.utils.get(bot.get_guild(int(GUILD_ID)).channels, name="logs")
-        if log_channel:
-            ip_address = request.remote_addr
-            bot.loop.create_task(log_channel.send(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Script executed with key `{key}` | Discord ID: {discord_id} | IP: {ip_address}"))
+        row = key_cache.get(key)
+        discord_id = row[1] if row else "Unknown"
+
+        ip_address = request.remote_addr
+        outbox.log(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Script executed with key `{key}` | Discord ID: {discord_id} | IP: {ip_address}")
+        usage_recorder.record(key, row[1] if row else None, "script_execution", ip_address)
         
         return jsonify({"success": "Execution logged"}), 200
     except Exception as e:
         return jsonify({"error": "Server error"}), 500
 
+# Route to expose key cache counters
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify(key_cache.stats()), 200
+
+# Prometheus metrics endpoint
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    lines = []
+    for metric in (http_requests_total, http_request_seconds, sqlite_query_seconds, expire_run_seconds, rate_limited_total):
+        lines += metric.render()
+
+    sink = log_sink.stats()
+    gauges = [
+        ("zhacks_discord_gateway_latency_seconds", "gauge", "Discord gateway heartbeat latency.", bot.latency),
+        ("zhacks_discord_log_queue_depth", "gauge", "Log lines waiting to be sent to Discord.", sink["pending"]),
+        ("zhacks_discord_log_dropped_total", "counter", "Log lines dropped because the queue was full.", sink["dropped"]),
+        ("zhacks_discord_log_rate_limited_total", "counter", "Log sends rejected with HTTP 429.", sink["rate_limited"]),
+        ("zhacks_vip_role_queue_depth", "gauge", "VIP role changes waiting to be applied.", vip_reconciler.pending()),
+        ("zhacks_vip_role_failed_total", "counter", "VIP role changes that failed after retries.", vip_reconciler.failed),
+        ("zhacks_rate_limit_buckets", "gauge", "Token buckets currently tracked by the rate limiter.", len(rate_limiter)),
+    ]
+    usage = usage_recorder.stats()
+    pending_outbox = outbox.stats()
+    gauges += [
+        ("zhacks_outbox_depth", "gauge", "Outbox entries waiting for the bot to deliver them.", pending_outbox["depth"]),
+        ("zhacks_outbox_dropped_total", "counter", "Outbox log lines dropped to keep the table under OUTBOX_MAX_ROWS.", pending_outbox["dropped"]),
+        ("zhacks_usage_buffer_depth", "gauge", "Usage events waiting to be written.", usage["pending"]),
+        ("zhacks_usage_dropped_total", "counter", "Usage events dropped because the buffer was full.", usage["dropped"]),
+    ]
+    cache = key_cache.stats()
+    gauges += [
+        ("zhacks_key_cache_size", "gauge", "Key rows held in the cache.", cache["size"]),
+        ("zhacks_key_cache_hits_total", "counter", "Key cache hits.", cache["hits"]),
+        ("zhacks_key_cache_misses_total", "counter", "Key cache misses.", cache["misses"]),
+        ("zhacks_key_cache_evictions_total", "counter", "Key cache evictions.", cache["evictions"]),
+    ]
+    for name, kind, help_text, value in gauges:
+        if value != value or value in (float("inf"), float("-inf")):
+            continue  # bot.latency is NaN/inf until the first heartbeat
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4"), 200
+
 # Generate a unique key
+KEY_ALPHABET = string.ascii_uppercase + string.digits
+KEY_LENGTH = 8
+BULK_MINT_MAX = int(os.getenv("BULK_MINT_MAX", 10000))
+
 def generate_unique_key():
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+    return ''.join(secrets.choice(KEY_ALPHABET) for _ in range(KEY_LENGTH))
+
+# Key allocator: draws candidates from a CSPRNG, drops any that already exist, and
+# inserts the batch with one executemany. BEGIN IMMEDIATE holds the write lock from the
+# existence check to the insert, so a concurrent writer can't cause an IntegrityError.
+def allocate_keys(count, user_id, expiration, registration_date):
+    keys = set()
+    with db_cursor() as cursor:
+        cursor.execute("BEGIN IMMEDIATE")
+        while len(keys) < count:
+            batch = set()
+            while len(batch) < count - len(keys):
+                key = generate_unique_key()
+                if key not in keys:
+                    batch.add(key)
+            cursor.execute("SELECT key FROM keys WHERE key IN (SELECT value FROM json_each(?))",
+                           (json.dumps(list(batch)),))
+            batch.difference_update(row[0] for row in cursor.fetchall())
+            keys |= batch
+        cursor.executemany("INSERT INTO keys (key, user_id, expiration, status, registration_date, android_uid) VALUES (?, ?, ?, ?, ?, ?)",
+                           [(key, user_id, expiration, "active", registration_date, None) for key in keys])
+    keys = sorted(keys)
+    key_cache.invalidate(*keys)
+    expiration_scheduler.resync()
+    return keys
 
 # Check if user is admin
 def is_admin(user):
     return any(role.id == int(ADMIN_ROLE_ID) for role in user.roles)
 
 # View for ticket actions (including Close button for admins)
+# Ticket store. Opening a ticket reserves a row first, so the unique index turns a
+# repeated click into a pointer to the existing ticket instead of another channel.
+# TICKET_MODE "thread" opens private threads under buy-hack-ticket instead of
+# channels (admins need Manage Threads there to see them).
+TICKET_MODE = os.getenv("TICKET_MODE", "channel")  # "channel" or "thread"
+TICKET_TRANSCRIPT_LIMIT = int(os.getenv("TICKET_TRANSCRIPT_LIMIT", 5000))
+TICKET_OPENING_TIMEOUT = int(os.getenv("TICKET_OPENING_TIMEOUT", 300))
+
+# type -> (name prefix, topic, greeting, confirmation)
+TICKET_TYPES = {
+    "bug": ("bug", "Bug report", "Bug report ticket created by {mention}. Please describe the issue with the script in detail.",
+            "Your bug report ticket has been created: {link}"),
+    "payment": ("payment", "Payment request", "Payment request ticket created by {mention}. Please specify your payment method and the plan you are interested in (e.g., 7-day VIP key).",
+                "Your payment request ticket has been created: {link}"),
+}
+
+class TicketStore:
+    def reserve(self, user_id, ticket_type):
+        # Returns (ticket_id, None) for a new reservation or (None, existing row)
+        now = int(time.time())
+        with db_cursor() as cursor:
+            cursor.execute("BEGIN IMMEDIATE")
+            # A reservation left behind by a crash mid-creation doesn't block the user forever
+            cursor.execute("DELETE FROM tickets WHERE user_id = ? AND type = ? AND status = 'opening' AND opened_at < ?",
+                           (user_id, ticket_type, now - TICKET_OPENING_TIMEOUT))
+            cursor.execute("SELECT id, status, channel_id FROM tickets WHERE user_id = ? AND type = ? AND status != 'closed'",
+                           (user_id, ticket_type))
+            existing = cursor.fetchone()
+            if existing:
+                return None, existing
+            cursor.execute("INSERT INTO tickets (user_id, type, status, opened_at) VALUES (?, ?, 'opening', ?)",
+                           (user_id, ticket_type, now))
+            return cursor.lastrowid, None
+
+    def activate(self, ticket_id, channel_id):
+        with db_cursor() as cursor:
+            cursor.execute("UPDATE tickets SET status = 'open', channel_id = ? WHERE id = ?", (channel_id, ticket_id))
+
+    def cancel(self, ticket_id):
+        with db_cursor() as cursor:
+            cursor.execute("DELETE FROM tickets WHERE id = ? AND status = 'opening'", (ticket_id,))
+
+    def by_channel(self, channel_id):
+        with db_cursor() as cursor:
+            cursor.execute("SELECT id, user_id, type FROM tickets WHERE channel_id = ? AND status = 'open'", (channel_id,))
+            return cursor.fetchone()
+
+    def close(self, ticket_id, closed_by, transcript=()):
+        # Archive the transcript and close the ticket in one transaction
+        with db_cursor() as cursor:
+            cursor.executemany("INSERT OR IGNORE INTO ticket_messages (ticket_id, message_id, author_id, author_name, created_at, content, attachments) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               [(ticket_id,) + row for row in transcript])
+            cursor.execute("UPDATE tickets SET status = 'closed', closed_at = ?, closed_by = ? WHERE id = ? AND status != 'closed'",
+                           (int(time.time()), closed_by, ticket_id))
+
+    def channel_deleted(self, channel_id):
+        with db_cursor() as cursor:
+            cursor.execute("UPDATE tickets SET status = 'closed', closed_at = ? WHERE channel_id = ? AND status = 'open'",
+                           (int(time.time()), channel_id))
+
+ticket_store = TicketStore()
+
+async def resolve_ticket_channel(guild, channel_id):
+    channel = guild.get_channel_or_thread(channel_id)
+    if channel:
+        return channel
+    try:
+        return await guild.fetch_channel(channel_id)  # archived threads aren't cached
+    except (discord.NotFound, discord.Forbidden):
+        return None
+
+async def open_ticket(interaction, ticket_type):
+    guild = interaction.guild
+    user = interaction.user
+    prefix, topic, greeting, confirmation = TICKET_TYPES[ticket_type]
+
+    ticket_id, existing = await asyncio.to_thread(ticket_store.reserve, str(user.id), ticket_type)
+    if existing:
+        _, status, channel_id = existing
+        channel = await resolve_ticket_channel(guild, channel_id) if channel_id else None
+        if channel:
+            await interaction.response.send_message(f"You already have an open ticket: {channel.mention}", ephemeral=True)
+            return
+        if status == "opening":
+            await interaction.response.send_message("Your ticket is being created, please wait a moment.", ephemeral=True)
+            return
+        # The ticket's channel is gone: close the stale record and open a new one
+        await asyncio.to_thread(ticket_store.channel_deleted, channel_id)
+        ticket_id, existing = await asyncio.to_thread(ticket_store.reserve, str(user.id), ticket_type)
+        if existing:
+            await interaction.response.send_message("Your ticket is being created, please wait a moment.", ephemeral=True)
+            return
+
+    await interaction.response.defer(ephemeral=True)
+    try:
+        if TICKET_MODE == "thread":
+            parent = registry.channel("buy-hack-ticket")
+            ticket_channel = await parent.create_thread(
+                name=f"{prefix}-{user.name}",
+                type=discord.ChannelType.private_thread,
+                invitable=False
+            )
+            await ticket_channel.add_user(user)
+        else:
+            overwrites = {
+                guild.default_role: discord.PermissionOverwrite(view_channel=False),
+                user: discord.PermissionOverwrite(view_channel=True, send_messages=True),
+                guild.get_role(int(ADMIN_ROLE_ID)): discord.PermissionOverwrite(view_channel=True, send_messages=True)
+            }
+            ticket_channel = await guild.create_text_channel(
+                f"{prefix}-{user.name}",
+                overwrites=overwrites,
+                topic=f"{topic} by {user.name}",
+                category=registry.category("Tickets")
+            )
+    except Exception:
+        await asyncio.to_thread(ticket_store.cancel, ticket_id)
+        await interaction.followup.send("Could not create your ticket, please try again later.", ephemeral=True)
+        raise
+    await asyncio.to_thread(ticket_store.activate, ticket_id, ticket_channel.id)
+    await ticket_channel.send(greeting.format(mention=user.mention), view=TicketActionsView())
+    await interaction.followup.send(confirmation.format(link=ticket_channel.mention), ephemeral=True)
+
+# Transcript rows (message_id, author_id, author_name, created_at, content, attachments) and a text rendering
+async def fetch_transcript(channel):
+    rows, lines = [], []
+    async for message in channel.history(limit=TICKET_TRANSCRIPT_LIMIT, oldest_first=True):
+        attachments = [attachment.url for attachment in message.attachments]
+        rows.append((message.id, str(message.author.id), str(message.author), to_epoch(message.created_at),
+                     message.content, json.dumps(attachments)))
+        lines.append(f"[{message.created_at.strftime('%Y-%m-%d %H:%M:%S')}] {message.author}: {message.content}"
+                     + "".join(f"\n    {url}" for url in attachments))
+    return rows, "\n".join(lines)
+
 class TicketActionsView(View):
     def __init__(self):
         super().__init__(timeout=None)  # Persistent view
@@ -265,10 +2102,19 @@ class TicketActionsView(View):
             return
         
         channel = interaction.channel
-        await channel.send(f"Ticket closed by {interaction.user.mention}.")
-        log_channel = discord.utils.get(interaction.guild.channels, name="logs")
-        if log_channel:
-            await log_channel.send(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Ticket {channel.name} closed by {interaction.user.mention}")
+        await interaction.response.send_message(f"Ticket closed by {interaction.user.mention}.")
+
+        # Archive the transcript in SQLite and as a file in the logs channel, then delete
+        rows, text = await fetch_transcript(channel)
+        ticket = await asyncio.to_thread(ticket_store.by_channel, channel.id)
+        if ticket:
+            await asyncio.to_thread(ticket_store.close, ticket[0], str(interaction.user.id), rows)
+        logs_channel = registry.channel("logs")
+        if logs_channel:
+            await logs_channel.send(
+                f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Ticket {channel.name} closed by {interaction.user.mention} ({len(rows)} messages)",
+                file=discord.File(io.BytesIO(text.encode()), filename=f"{channel.name}-transcript.txt")
+            )
         await channel.delete()
 
 # Buttons for tickets
@@ -278,39 +2124,11 @@ class TicketView(View):
 
     @discord.ui.button(label="Report a Bug", style=discord.ButtonStyle.red, custom_id="report_bug")
     async def report_bug(self, interaction: discord.Interaction, button: Button):
-        guild = interaction.guild
-        user = interaction.user
-        overwrites = {
-            guild.default_role: discord.PermissionOverwrite(view_channel=False),
-            user: discord.PermissionOverwrite(view_channel=True, send_messages=True),
-            guild.get_role(int(ADMIN_ROLE_ID)): discord.PermissionOverwrite(view_channel=True, send_messages=True)
-        }
-        ticket_channel = await guild.create_text_channel(
-            f"bug-{user.name}",
-            overwrites=overwrites,
-            topic=f"Bug report by {user.name}",
-            category=discord.utils.get(guild.categories, name="Tickets")
-        )
-        await ticket_channel.send(f"Bug report ticket created by {user.mention}. Please describe the issue with the script in detail.", view=TicketActionsView())
-        await interaction.response.send_message(f"Your bug report ticket has been created: {ticket_channel.mention}", ephemeral=True)
+        await open_ticket(interaction, "bug")
 
     @discord.ui.button(label="Request Payment Info", style=discord.ButtonStyle.green, custom_id="request_payment")
     async def request_payment(self, interaction: discord.Interaction, button: Button):
-        guild = interaction.guild
-        user = interaction.user
-        overwrites = {
-            guild.default_role: discord.PermissionOverwrite(view_channel=False),
-            user: discord.PermissionOverwrite(view_channel=True, send_messages=True),
-            guild.get_role(int(ADMIN_ROLE_ID)): discord.PermissionOverwrite(view_channel=True, send_messages=True)
-        }
-        ticket_channel = await guild.create_text_channel(
-            f"payment-{user.name}",
-            overwrites=overwrites,
-            topic=f"Payment request by {user.name}",
-            category=discord.utils.get(guild.categories, name="Tickets")
-        )
-        await ticket_channel.send(f"Payment request ticket created by {user.mention}. Please specify your payment method and the plan you are interested in (e.g., 7-day VIP key).", view=TicketActionsView())
-        await interaction.response.send_message(f"Your payment request ticket has been created: {ticket_channel.mention}", ephemeral=True)
+        await open_ticket(interaction, "payment")
 
 # Buttons for admin interface
 class AdminView(View):
@@ -324,6 +2142,13 @@ class AdminView(View):
             return
         await interaction.response.send_modal(AddKeyModal())
 
+    @discord.ui.button(label="Bulk Mint", style=discord.ButtonStyle.green, custom_id="bulk_mint")
+    async def bulk_mint(self, interaction: discord.Interaction, button: Button):
+        if not is_admin(interaction.user):
+            await interaction.response.send_message("Only admins can use this!", ephemeral=True)
+            return
+        await interaction.response.send_modal(BulkMintModal())
+
     @discord.ui.button(label="Check Key", style=discord.ButtonStyle.blurple, custom_id="check_key")
     async def check_key(self, interaction: discord.Interaction, button: Button):
         if not is_admin(interaction.user):
@@ -350,13 +2175,8 @@ class AdminView(View):
         if not is_admin(interaction.user):
             await interaction.response.send_message("Only admins can use this!", ephemeral=True)
             return
-        cursor.execute("SELECT * FROM keys WHERE status = 'active'")
-        keys = cursor.fetchall()
-        if keys:
-            keys_list = "\n".join([f"Key: `{k[0]}` | User: <@{k[1]}> | Registered: {k[4].split('T')[0]} | Expires: {k[2].split('T')[0]}" for k in keys])
-            await interaction.response.send_message(f"**Active Keys:**\n{keys_list}", ephemeral=True)
-        else:
-            await interaction.response.send_message("No active keys found.", ephemeral=True)
+        view = KeysPageView(KeyFilter())
+        await interaction.response.send_message(view.load(), view=view, ephemeral=True)
 
     @discord.ui.button(label="Revoke Key", style=discord.ButtonStyle.red, custom_id="revoke_key")
     async def revoke_key(self, interaction: discord.Interaction, button: Button):
@@ -379,6 +2199,205 @@ class AdminView(View):
             return
         await interaction.response.send_modal(MaintenanceModal())
 
+    @discord.ui.button(label="Sync VIP Roles", style=discord.ButtonStyle.grey, custom_id="sync_vip_roles")
+    async def sync_vip_roles(self, interaction: discord.Interaction, button: Button):
+        if not is_admin(interaction.user):
+            await interaction.response.send_message("Only admins can use this!", ephemeral=True)
+            return
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        added, removed = await vip_reconciler.reconcile()
+        message = await interaction.followup.send(f"VIP sync: {added} to add, {removed} to remove.", ephemeral=True, wait=True)
+        # Report progress until the worker has drained the queue
+        while vip_reconciler.pending():
+            await asyncio.sleep(5)
+            await message.edit(content=f"VIP sync: {added} to add, {removed} to remove, {vip_reconciler.pending()} remaining.")
+        if added or removed:
+            await message.edit(content=f"VIP sync complete: {added} added, {removed} removed.")
+
+    @discord.ui.button(label="Export Keys", style=discord.ButtonStyle.grey, custom_id="export_keys")
+    async def export_keys(self, interaction: discord.Interaction, button: Button):
+        if not is_admin(interaction.user):
+            await interaction.response.send_message("Only admins can use this!", ephemeral=True)
+            return
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        await send_keys_export(functools.partial(interaction.followup.send, ephemeral=True), KeyFilter("all"), "Existing Keys")
+
+# Filters for the keys browser and exports
+KEYS_PAGE_SIZE = int(os.getenv("KEYS_PAGE_SIZE", 15))
+
+class KeyFilter:
+    def __init__(self, status="active", expiring_days=None, user_id=None):
+        self.status = status
+        self.expiring_days = expiring_days
+        self.user_id = user_id
+
+    def where(self):
+        clauses, params = [], []
+        if self.status != "all":
+            clauses.append("status = ?")
+            params.append(self.status)
+        if self.expiring_days is not None:
+            clauses.append("expiration <= ?")
+            params.append(int(time.time()) + self.expiring_days * 86400)
+        if self.user_id:
+            clauses.append("user_id = ?")
+            params.append(self.user_id)
+        return clauses, params
+
+    def describe(self):
+        parts = ["all" if self.status == "all" else self.status.capitalize()]
+        if self.expiring_days is not None:
+            parts.append(f"expiring within {self.expiring_days} days")
+        if self.user_id:
+            parts.append(f"user <@{self.user_id}>")
+        return ", ".join(parts)
+
+# Keyset pagination over (expiration, key): each page reads only its own rows from the index
+def fetch_keys_page(key_filter, after=None, before=None, limit=KEYS_PAGE_SIZE):
+    clauses, params = key_filter.where()
+    order = "ASC"
+    if after:
+        clauses.append("(expiration, key) > (?, ?)")
+        params += after
+    elif before:
+        clauses.append("(expiration, key) < (?, ?)")
+        params += before
+        order = "DESC"
+    query = "SELECT * FROM keys"
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    query += f" ORDER BY expiration {order}, key {order} LIMIT ?"
+    with db_cursor() as cursor:
+        cursor.execute(query, params + [limit + 1])
+        rows = cursor.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if before:
+        rows.reverse()
+    return rows, has_more
+
+def format_key_line(k, with_status=False):
+    line = f"Key: `{k[0]}` | User: <@{k[1]}> | Registered: {epoch_to_date(k[4])} | Expires: {epoch_to_date(k[2])}"
+    if with_status:
+        line += f" | Status: {k[3]}"
+    return line
+
+# Key inventory export. Rows are streamed from the cursor, either packed into
+# message-sized chunks (small inventories) or written to a CSV/JSONL temp file.
+KEYS_EXPORT_FORMAT = os.getenv("KEYS_EXPORT_FORMAT", "csv")  # "csv" or "jsonl"
+KEYS_EXPORT_INLINE_MAX = int(os.getenv("KEYS_EXPORT_INLINE_MAX", 50))
+KEY_EXPORT_FIELDS = ["key", "user_id", "expiration", "status", "registration_date", "android_uid"]
+
+def iter_keys(key_filter):
+    clauses, params = key_filter.where()
+    query = "SELECT * FROM keys"
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    query += " ORDER BY expiration, key"
+    with db_cursor() as cursor:
+        cursor.execute(query, params)
+        yield from cursor
+
+def count_keys(key_filter):
+    clauses, params = key_filter.where()
+    query = "SELECT COUNT(*) FROM keys"
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    with db_cursor() as cursor:
+        cursor.execute(query, params)
+        return cursor.fetchone()[0]
+
+def export_keys(key_filter, fmt="csv"):
+    if fmt not in ["csv", "jsonl"]:
+        raise ValueError(f"Unknown export format: {fmt}")
+    fp = tempfile.TemporaryFile()
+    text = io.TextIOWrapper(fp, encoding="utf-8", newline="")
+    writer = csv.writer(text)
+    if fmt == "csv":
+        writer.writerow(KEY_EXPORT_FIELDS)
+    for k in iter_keys(key_filter):
+        values = [k[0], k[1], epoch_to_iso(k[2]), k[3], epoch_to_iso(k[4]), k[5]]
+        if fmt == "csv":
+            writer.writerow(values)
+        else:
+            text.write(json.dumps(dict(zip(KEY_EXPORT_FIELDS, values))) + "\n")
+    text.flush()
+    text.detach()
+    fp.seek(0)
+    return fp
+
+def key_message_chunks(key_filter, title):
+    chunk = f"**{title}:**"
+    for k in iter_keys(key_filter):
+        line = format_key_line(k, with_status=True)
+        if len(chunk) + len(line) + 1 > DISCORD_MESSAGE_LIMIT:
+            yield chunk
+            chunk = line
+        else:
+            chunk += "\n" + line
+    yield chunk
+
+# Send an export through any send coroutine (channel.send, interaction.followup.send, ...)
+async def send_keys_export(send, key_filter, title, fmt=KEYS_EXPORT_FORMAT):
+    count = await asyncio.to_thread(count_keys, key_filter)
+    if not count:
+        await send("No keys registered yet.")
+    elif count <= KEYS_EXPORT_INLINE_MAX:
+        for chunk in await asyncio.to_thread(lambda: list(key_message_chunks(key_filter, title))):
+            await send(chunk)
+    else:
+        fp = await asyncio.to_thread(export_keys, key_filter, fmt)
+        with fp:
+            await send(f"**{title}:** {count} keys", file=discord.File(fp, filename=f"keys.{fmt}"))
+
+# Paginated keys browser sent in reply to "List Keys"
+class KeysPageView(View):
+    def __init__(self, key_filter):
+        super().__init__(timeout=600)
+        self.key_filter = key_filter
+        self.page = 1
+        self.first = None
+        self.last = None
+
+    def load(self, after=None, before=None):
+        rows, has_more = fetch_keys_page(self.key_filter, after=after, before=before)
+        if before:
+            self.page -= 1
+            self.previous_page.disabled = not has_more
+            self.next_page.disabled = False
+        else:
+            if after:
+                self.page += 1
+            self.previous_page.disabled = self.page == 1
+            self.next_page.disabled = not has_more
+        if not rows:
+            self.previous_page.disabled = self.next_page.disabled = True
+            return f"No keys found ({self.key_filter.describe()})."
+        self.first = (rows[0][2], rows[0][0])
+        self.last = (rows[-1][2], rows[-1][0])
+        with_status = self.key_filter.status == "all"
+        keys_list = "\n".join(format_key_line(k, with_status) for k in rows)
+        return f"**Keys ({self.key_filter.describe()}) - page {self.page}:**\n{keys_list}"[:DISCORD_MESSAGE_LIMIT]
+
+    @discord.ui.button(label="Prev", style=discord.ButtonStyle.grey)
+    async def previous_page(self, interaction: discord.Interaction, button: Button):
+        await interaction.response.edit_message(content=self.load(before=self.first), view=self)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.grey)
+    async def next_page(self, interaction: discord.Interaction, button: Button):
+        await interaction.response.edit_message(content=self.load(after=self.last), view=self)
+
+    @discord.ui.button(label="Filter", style=discord.ButtonStyle.blurple)
+    async def filter_keys(self, interaction: discord.Interaction, button: Button):
+        await interaction.response.send_modal(KeyFilterModal())
+
+    @discord.ui.button(label="Export CSV", style=discord.ButtonStyle.green)
+    async def export_csv(self, interaction: discord.Interaction, button: Button):
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        fp = await asyncio.to_thread(export_keys, self.key_filter, "csv")
+        with fp:
+            await interaction.followup.send(file=discord.File(fp, filename="keys.csv"), ephemeral=True)
+
 # Modals for input
 class AddKeyModal(Modal, title="Add a VIP Key"):
     duration = TextInput(label="Duration (days)", placeholder="e.g., 7")
@@ -390,37 +2409,86 @@ class AddKeyModal(Modal, title="Add a VIP Key"):
             user_id = self.user_id.value
 
             # Check if user is banned
-            cursor.execute("SELECT * FROM banned_users WHERE user_id = ?", (user_id,))
-            if cursor.fetchone():
+            if ban_list.is_banned(user_id):
                 await interaction.response.send_message("This user is banned and cannot receive a key!", ephemeral=True)
                 return
 
-            key = generate_unique_key()
             expiration = datetime.now() + timedelta(days=duration_days)
-            registration_date = datetime.now().isoformat()
-            cursor.execute("INSERT INTO keys (key, user_id, expiration, status, registration_date, android_uid) VALUES (?, ?, ?, ?, ?, ?)",
-                           (key, user_id, expiration.isoformat(), "active", registration_date, None))
-            db.commit()
+            registration_date = datetime.now()
+            key = (await asyncio.to_thread(allocate_keys, 1, user_id, to_epoch(expiration), to_epoch(registration_date)))[0]
+            audit_log.record(interaction.user, "add_key", key, user_id,
+                             after=key_snapshot((key, user_id, to_epoch(expiration), "active", to_epoch(registration_date), None)))
             user = await bot.fetch_user(int(user_id))
             await user.send(f"Your VIP Key: `{key}`\nExpires on: {expiration.strftime('%Y-%m-%d')}")
             await interaction.response.send_message(f"Key sent to <@{user_id}>!", ephemeral=True)
             
-            keys_channel = discord.utils.get(interaction.guild.channels, name="keys")
+            keys_channel = registry.channel("keys")
             if keys_channel:
-                await keys_channel.send(f"Key: `{key}`\nUser: {user.name} (<@{user_id}>)\nRegistered: {registration_date.split('T')[0]}\nExpires: {expiration.strftime('%Y-%m-%d')}")
+                await keys_channel.send(f"Key: `{key}`\nUser: {user.name} (<@{user_id}>)\nRegistered: {registration_date.strftime('%Y-%m-%d')}\nExpires: {expiration.strftime('%Y-%m-%d')}")
         except ValueError:
             await interaction.response.send_message("Duration must be an integer!", ephemeral=True)
 
+class KeyFilterModal(Modal, title="Filter Keys"):
+    status = TextInput(label="Status (active/inactive/all)", placeholder="e.g., active", required=False)
+    expiring_days = TextInput(label="Expiring within (days)", placeholder="e.g., 7", required=False)
+    user_id = TextInput(label="User ID", placeholder="e.g., 123456789", required=False)
+
+    async def on_submit(self, interaction: discord.Interaction):
+        status = (self.status.value or "active").lower()
+        if status not in ["active", "inactive", "all"]:
+            await interaction.response.send_message("Invalid status! Use 'active', 'inactive', or 'all'.", ephemeral=True)
+            return
+        try:
+            expiring_days = int(self.expiring_days.value) if self.expiring_days.value else None
+        except ValueError:
+            await interaction.response.send_message("Days must be an integer!", ephemeral=True)
+            return
+        view = KeysPageView(KeyFilter(status, expiring_days, self.user_id.value or None))
+        await interaction.response.send_message(view.load(), view=view, ephemeral=True)
+
+class BulkMintModal(Modal, title="Bulk Mint VIP Keys"):
+    count = TextInput(label=f"Number of keys (max {BULK_MINT_MAX})", placeholder="e.g., 100")
+    duration = TextInput(label="Duration (days)", placeholder="e.g., 7")
+
+    async def on_submit(self, interaction: discord.Interaction):
+        try:
+            count = int(self.count.value)
+            duration_days = int(self.duration.value)
+        except ValueError:
+            await interaction.response.send_message("Count and duration must be integers!", ephemeral=True)
+            return
+        if not 0 < count <= BULK_MINT_MAX:
+            await interaction.response.send_message(f"Count must be between 1 and {BULK_MINT_MAX}!", ephemeral=True)
+            return
+
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        expiration = datetime.now() + timedelta(days=duration_days)
+        registration_date = datetime.now()
+        keys = await asyncio.to_thread(allocate_keys, count, None, to_epoch(expiration), to_epoch(registration_date))
+        for key in keys:
+            audit_log.record(interaction.user, "bulk_mint", key,
+                             after=key_snapshot((key, None, to_epoch(expiration), "active", to_epoch(registration_date), None)))
+
+        batch_file = io.BytesIO("".join(f"{key},{expiration.strftime('%Y-%m-%d')}\n" for key in keys).encode())
+        await interaction.followup.send(f"Minted {len(keys)} keys expiring on {expiration.strftime('%Y-%m-%d')}.",
+                                        file=discord.File(batch_file, filename=f"keys-{len(keys)}x{duration_days}d.csv"),
+                                        ephemeral=True)
+
+        keys_channel = registry.channel("keys")
+        if keys_channel:
+            await keys_channel.send(f"Minted {len(keys)} keys by {interaction.user.mention}\nRegistered: {registration_date.strftime('%Y-%m-%d')}\nExpires: {expiration.strftime('%Y-%m-%d')}")
+
 class CheckKeyModal(Modal, title="Check a VIP Key"):
     key = TextInput(label="Key", placeholder="e.g., ABC123")
 
     async def on_submit(self, interaction: discord.Interaction):
-        cursor.execute("SELECT * FROM keys WHERE key = ?", (self.key.value,))
-        row = cursor.fetchone()
+        with db_cursor() as cursor:
+            cursor.execute("SELECT * FROM keys WHERE key = ?", (self.key.value,))
+            row = cursor.fetchone()
         if row:
             user_id, expiration, status, registration_date = row[1], row[2], row[3], row[4]
             await interaction.response.send_message(
-                f"Key: `{self.key.value}`\nUser: <@{user_id}>\nRegistered: {registration_date.split('T')[0]}\nExpiration: {expiration.split('T')[0]}\nStatus: {status}",
+                f"Key: `{self.key.value}`\nUser: <@{user_id}>\nRegistered: {epoch_to_date(registration_date)}\nExpiration: {epoch_to_date(expiration)}\nStatus: {status}",
                 ephemeral=True
             )
         else:
@@ -433,16 +2501,25 @@ class ExtendKeyModal(Modal, title="Extend a VIP Key"):
     async def on_submit(self, interaction: discord.Interaction):
         try:
             extra_days = int(self.duration.value)
-            cursor.execute("SELECT * FROM keys WHERE key = ?", (self.key.value,))
-            row = cursor.fetchone()
+            with db_cursor() as cursor:
+                cursor.execute("SELECT * FROM keys WHERE key = ?", (self.key.value,))
+                row = cursor.fetchone()
+                if row:
+                    current_expiration = datetime.fromtimestamp(row[2])
+                    new_expiration = current_expiration + timedelta(days=extra_days)
+                    cursor.execute("UPDATE keys SET expiration = ? WHERE key = ?", (to_epoch(new_expiration), self.key.value))
+                    # A negative extension shortens the key past what issued tokens claim
+                    if extra_days < 0:
+                        record_revocations(cursor, [self.key.value])
             if row:
-                current_expiration = datetime.fromisoformat(row[2])
-                new_expiration = current_expiration + timedelta(days=extra_days)
-                cursor.execute("UPDATE keys SET expiration = ? WHERE key = ?", (new_expiration.isoformat(), self.key.value))
-                db.commit()
+                audit_log.record(interaction.user, "extend_key", self.key.value, row[1],
+                                 before={"expiration": epoch_to_iso(row[2])},
+                                 after={"expiration": epoch_to_iso(to_epoch(new_expiration))})
+                key_cache.invalidate(self.key.value)
+                expiration_scheduler.resync()
                 await interaction.response.send_message(f"Key `{self.key.value}` extended until {new_expiration.strftime('%Y-%m-%d')}", ephemeral=True)
                 
-                keys_channel = discord.utils.get(interaction.guild.channels, name="keys")
+                keys_channel = registry.channel("keys")
                 if keys_channel:
                     await keys_channel.send(f"Key `{self.key.value}` extended until {new_expiration.strftime('%Y-%m-%d')}")
             else:
@@ -454,28 +2531,25 @@ class DeleteKeyModal(Modal, title="Delete a VIP Key"):
     key = TextInput(label="Key", placeholder="e.g., ABC123")
 
     async def on_submit(self, interaction: discord.Interaction):
-        cursor.execute("SELECT user_id FROM keys WHERE key = ?", (self.key.value,))
-        row = cursor.fetchone()
+        with db_cursor() as cursor:
+            cursor.execute("SELECT * FROM keys WHERE key = ?", (self.key.value,))
+            row = cursor.fetchone()
+            if row:
+                cursor.execute("DELETE FROM keys WHERE key = ?", (self.key.value,))
+                record_revocations(cursor, [self.key.value])
         if row:
-            user_id = row[0]
-            cursor.execute("DELETE FROM keys WHERE key = ?", (self.key.value,))
-            db.commit()
+            audit_log.record(interaction.user, "delete_key", self.key.value, row[1], before=key_snapshot(row))
+            key_cache.invalidate(self.key.value)
+            expiration_scheduler.resync()
+            user_id = row[1]
             await interaction.response.send_message(f"Key `{self.key.value}` deleted.", ephemeral=True)
             
-            keys_channel = discord.utils.get(interaction.guild.channels, name="keys")
+            keys_channel = registry.channel("keys")
             if keys_channel:
                 await keys_channel.send(f"Key `{self.key.value}` deleted.")
 
             # Remove VIP role from user
-            guild = interaction.guild
-            member = guild.get_member(int(user_id))
-            if member:
-                vip_role = guild.get_role(int(VIP_ROLE_ID))
-                if vip_role and vip_role in member.roles:
-                    await member.remove_roles(vip_role)
-                    log_channel = discord.utils.get(guild.channels, name="logs")
-                    if log_channel:
-                        await log_channel.send(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] VIP role removed from user {user_id} due to key deletion")
+            await vip_reconciler.reconcile([user_id], "due to key deletion")
         else:
             await interaction.response.send_message("Key not found.", ephemeral=True)
 
@@ -483,47 +2557,44 @@ class RevokeKeyModal(Modal, title="Revoke a VIP Key"):
     key = TextInput(label="Key", placeholder="e.g., ABC123")
 
     async def on_submit(self, interaction: discord.Interaction):
-        cursor.execute("SELECT user_id FROM keys WHERE key = ?", (self.key.value,))
-        row = cursor.fetchone()
+        with db_cursor() as cursor:
+            cursor.execute("SELECT user_id, status FROM keys WHERE key = ?", (self.key.value,))
+            row = cursor.fetchone()
+            if row:
+                cursor.execute("UPDATE keys SET status = 'inactive' WHERE key = ?", (self.key.value,))
+                record_revocations(cursor, [self.key.value])
         if row:
+            audit_log.record(interaction.user, "revoke_key", self.key.value, row[0],
+                             before={"status": row[1]}, after={"status": "inactive"})
+            key_cache.invalidate(self.key.value)
+            expiration_scheduler.resync()
             user_id = row[0]
-            cursor.execute("UPDATE keys SET status = 'inactive' WHERE key = ?", (self.key.value,))
-            db.commit()
             await interaction.response.send_message(f"Key `{self.key.value}` has been revoked.", ephemeral=True)
 
             # Remove VIP role from user
-            guild = interaction.guild
-            member = guild.get_member(int(user_id))
-            if member:
-                vip_role = guild.get_role(int(VIP_ROLE_ID))
-                if vip_role and vip_role in member.roles:
-                    await member.remove_roles(vip_role)
-                    log_channel = discord.utils.get(guild.channels, name="logs")
-                    if log_channel:
-                        await log_channel.send(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] VIP role removed from user {user_id} due to key revocation")
+            await vip_reconciler.reconcile([user_id], "due to key revocation")
         else:
             await interaction.response.send_message("Key not found.", ephemeral=True)
 
+def record_ban_audit(actor, user_ids, purged):
+    for user_id in user_ids:
+        audit_log.record(actor, "ban_user", target_user=user_id, after={"banned": True})
+    for row in purged:
+        audit_log.record(actor, "ban_purge_key", row[0], row[1], before=key_snapshot(row))
+
 class BanUserModal(Modal, title="Ban a User"):
     user_id = TextInput(label="User ID", placeholder="e.g., 123456789")
 
     async def on_submit(self, interaction: discord.Interaction):
         user_id = self.user_id.value
-        cursor.execute("INSERT OR IGNORE INTO banned_users (user_id) VALUES (?)", (user_id,))
-        cursor.execute("DELETE FROM keys WHERE user_id = ?", (user_id,))
-        db.commit()
+        purged = ban_list.ban([user_id])
+        record_ban_audit(interaction.user, [user_id], purged)
+        key_cache.invalidate(*[row[0] for row in purged])
+        expiration_scheduler.resync()
         await interaction.response.send_message(f"User <@{user_id}> has been banned and all their keys have been deleted.", ephemeral=True)
 
         # Remove VIP role from user
-        guild = interaction.guild
-        member = guild.get_member(int(user_id))
-        if member:
-            vip_role = guild.get_role(int(VIP_ROLE_ID))
-            if vip_role and vip_role in member.roles:
-                await member.remove_roles(vip_role)
-                log_channel = discord.utils.get(guild.channels, name="logs")
-                if log_channel:
-                    await log_channel.send(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] VIP role removed from user {user_id} due to ban")
+        await vip_reconciler.reconcile([user_id], "due to ban")
 
 class MaintenanceModal(Modal, title="Manage Maintenance Mode"):
     action = TextInput(label="Action (enable/disable/add_time)", placeholder="e.g., enable")
@@ -531,19 +2602,17 @@ class MaintenanceModal(Modal, title="Manage Maintenance Mode"):
 
     async def on_submit(self, interaction: discord.Interaction):
         action = self.action.value.lower()
-        log_channel = discord.utils.get(interaction.guild.channels, name="logs")
 
         if action not in ["enable", "disable", "add_time"]:
             await interaction.response.send_message("Invalid action! Use 'enable', 'disable', or 'add_time'.", ephemeral=True)
             return
 
         if action == "disable":
-            cursor.execute("UPDATE maintenance SET active = ?, end_time = ?, last_updated = ? WHERE id = ?",
-                           (False, None, datetime.now().isoformat(), 1))
-            db.commit()
+            before = maintenance_state.status()
+            maintenance_state.disable()
+            audit_log.record(interaction.user, "maintenance_disable", before=before, after=maintenance_state.status())
             await interaction.response.send_message("Maintenance mode disabled.", ephemeral=True)
-            if log_channel:
-                await log_channel.send(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Maintenance mode disabled by {interaction.user.mention}")
+            log_sink.log(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Maintenance mode disabled by {interaction.user.mention}")
             return
 
         if not self.duration.value:
@@ -560,89 +2629,386 @@ class MaintenanceModal(Modal, title="Manage Maintenance Mode"):
 
         if action == "enable":
             end_time = datetime.now() + timedelta(hours=duration_hours)
-            cursor.execute("UPDATE maintenance SET active = ?, end_time = ?, last_updated = ? WHERE id = ?",
-                           (True, end_time.isoformat(), datetime.now().isoformat(), 1))
-            db.commit()
+            before = maintenance_state.status()
+            maintenance_state.enable(end_time)
+            audit_log.record(interaction.user, "maintenance_enable", before=before, after=maintenance_state.status())
             await interaction.response.send_message(f"Maintenance mode enabled until {end_time.strftime('%Y-%m-%d %H:%M:%S')}.", ephemeral=True)
-            if log_channel:
-                await log_channel.send(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Maintenance mode enabled by {interaction.user.mention} until {end_time.strftime('%Y-%m-%d %H:%M:%S')}")
+            log_sink.log(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Maintenance mode enabled by {interaction.user.mention} until {end_time.strftime('%Y-%m-%d %H:%M:%S')}")
         elif action == "add_time":
-            cursor.execute("SELECT active, end_time FROM maintenance WHERE id = 1")
-            row = cursor.fetchone()
-            if not row or not row[0]:
+            current_end_time = maintenance_state.end_time()
+            if not current_end_time:
                 await interaction.response.send_message("Maintenance mode is not active! Enable it first.", ephemeral=True)
                 return
-            current_end_time = datetime.fromisoformat(row[1])
             if datetime.now() > current_end_time:
                 await interaction.response.send_message("Maintenance mode has already ended! Enable it again.", ephemeral=True)
                 return
             new_end_time = current_end_time + timedelta(hours=duration_hours)
-            cursor.execute("UPDATE maintenance SET end_time = ?, last_updated = ? WHERE id = ?",
-                           (new_end_time.isoformat(), datetime.now().isoformat(), 1))
-            db.commit()
+            before = maintenance_state.status()
+            maintenance_state.enable(new_end_time)
+            audit_log.record(interaction.user, "maintenance_extend", before=before, after=maintenance_state.status())
             await interaction.response.send_message(f"Maintenance time extended until {new_end_time.strftime('%Y-%m-%d %H:%M:%S')}.", ephemeral=True)
-            if log_channel:
-                await log_channel.send(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Maintenance time extended by {interaction.user.mention} until {new_end_time.strftime('%Y-%m-%d %H:%M:%S')}")
+            log_sink.log(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Maintenance time extended by {interaction.user.mention} until {new_end_time.strftime('%Y-%m-%d %H:%M:%S')}")
+
+# Bulk ban import: "!ban_import" with user IDs inline and/or in attached text/CSV files
+@bot.command(name="ban_import")
+@commands.guild_only()
+async def ban_import(ctx, *user_ids):
+    if not is_admin(ctx.author):
+        await ctx.send("Only admins can use this!")
+        return
+    ids = [user_id for user_id in user_ids if user_id.isdigit()]
+    for attachment in ctx.message.attachments:
+        ids += re.findall(r"\d{15,20}", (await attachment.read()).decode(errors="ignore"))
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        await ctx.send("No user IDs found. Pass IDs after the command or attach a text/CSV file.")
+        return
+    if len(ids) > BAN_IMPORT_MAX:
+        await ctx.send(f"Too many user IDs ({len(ids)}), the limit is {BAN_IMPORT_MAX}.")
+        return
+
+    purged = await asyncio.to_thread(ban_list.ban, ids)
+    record_ban_audit(ctx.author, ids, purged)
+    key_cache.invalidate(*[row[0] for row in purged])
+    expiration_scheduler.resync()
+    await ctx.send(f"Banned {len(ids)} user(s) and deleted {len(purged)} key(s).")
+    log_sink.log(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Bulk ban of {len(ids)} user(s) by {ctx.author.mention}, {len(purged)} key(s) deleted")
+
+    # Remove VIP role from banned members
+    await vip_reconciler.reconcile(ids, "due to ban")
+
+# Usage reports: "!usage_top [window] [limit]" (window like 6h, 24h, 7d) and "!usage_key <key> [days]"
+USAGE_WINDOW_RE = re.compile(r"^(\d+)([hd])$")
+
+# Reports expose keys, user IDs and IPs, so they are only answered in the admin channel
+def in_admin_channel(ctx):
+    admin_channel = registry.channel("admin")
+    return admin_channel is not None and ctx.channel.id == admin_channel.id
+
+@bot.command(name="usage_top")
+@commands.guild_only()
+async def usage_top(ctx, window="24h", limit: int = 10):
+    if not is_admin(ctx.author):
+        await ctx.send("Only admins can use this!")
+        return
+    if not in_admin_channel(ctx):
+        await ctx.send("Usage reports can only be used in the admin channel.")
+        return
+    match = USAGE_WINDOW_RE.match(window.lower())
+    if not match or not 1 <= limit <= 25:
+        await ctx.send("Usage: `!usage_top [window] [limit]`, e.g. `!usage_top 7d 10` (limit 1-25).")
+        return
+    seconds = int(match.group(1)) * (3600 if match.group(2) == "h" else 86400)
+    result = await asyncio.to_thread(usage_recorder.top, int(time.time()) - seconds, limit)
+
+    embed = discord.Embed(
+        title=f"Usage in the last {window}",
+        description=f"{result['total']} event(s)",
+        color=discord.Color.red()
+    )
+    for column, name in (("key", "Top Keys"), ("action", "Top Actions"), ("ip", "Top IPs")):
+        lines = [f"`{value or 'unknown'}`: {count}" for value, count in result[column]]
+        embed.add_field(name=name, value="\n".join(lines)[:1024] or "None", inline=True)
+    embed.set_footer(text="Powered by ZLI Hacks")
+    await ctx.send(embed=embed)
+
+@bot.command(name="usage_key")
+@commands.guild_only()
+async def usage_key(ctx, key, days: int = 7):
+    if not is_admin(ctx.author):
+        await ctx.send("Only admins can use this!")
+        return
+    if not in_admin_channel(ctx):
+        await ctx.send("Usage reports can only be used in the admin channel.")
+        return
+    rows = await asyncio.to_thread(usage_recorder.daily, key, max(1, min(days, USAGE_DAILY_RETENTION_DAYS)))
+    if not rows:
+        await ctx.send(f"No usage recorded for key `{key}` in the last {days} day(s).")
+        return
+    lines = [f"{datetime.utcfromtimestamp(bucket).strftime('%Y-%m-%d')} {action}: {count}" for bucket, action, count in rows]
+    header = f"**Usage for key `{key}` (last {days} day(s), UTC):**\n"
+    message = header
+    for line in lines:
+        if len(message) + len(line) + 1 > DISCORD_MESSAGE_LIMIT:
+            await ctx.send(message)
+            message = ""
+        message += line + "\n"
+    await ctx.send(message)
+
+# Audit history: "!audit <key | user ID | @user> [limit]"
+AUDIT_HISTORY_MAX = int(os.getenv("AUDIT_HISTORY_MAX", 200))
+
+def format_audit_entry(entry):
+    ts, actor_id, actor_name, action, target_key, target_user, before, after = entry
+    before = json.loads(before) if before else {}
+    after = json.loads(after) if after else {}
+    targets = " ".join(part for part in (f"key `{target_key}`" if target_key else "",
+                                          f"user <@{target_user}>" if target_user else "") if part)
+    if before and after:
+        changes = ", ".join(f"{field}: {before.get(field)} -> {after.get(field)}"
+                            for field in dict.fromkeys(list(before) + list(after)) if before.get(field) != after.get(field))
+    elif before:
+        changes = "was " + ", ".join(f"{field}={value}" for field, value in before.items())
+    elif after:
+        changes = "now " + ", ".join(f"{field}={value}" for field, value in after.items())
+    else:
+        changes = ""
+    line = f"{datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')} {action} {targets} by {actor_name} ({actor_id})"
+    return f"{line} | {changes}" if changes else line
+
+@bot.command(name="audit")
+@commands.guild_only()
+async def audit(ctx, target, limit: int = 50):
+    if not is_admin(ctx.author):
+        await ctx.send("Only admins can use this!")
+        return
+    if not in_admin_channel(ctx):
+        await ctx.send("Audit history can only be used in the admin channel.")
+        return
+    target = target.strip("<@!>") if re.fullmatch(r"<@!?\d+>", target) else target
+    entries = await asyncio.to_thread(audit_log.history, target, max(1, min(limit, AUDIT_HISTORY_MAX)))
+    if not entries:
+        await ctx.send(f"No audit entries for `{target}`.")
+        return
+    lines = [format_audit_entry(entry) for entry in entries]
+    header = f"**Audit history for `{target}` (newest first, {len(entries)} entries):**\n"
+    if len(header) + sum(len(line) + 1 for line in lines) > DISCORD_MESSAGE_LIMIT * 3:
+        await ctx.send(header, file=discord.File(io.BytesIO("\n".join(lines).encode()), filename=f"audit-{target}.txt"))
+        return
+    message = header
+    for line in lines:
+        line = line[:DISCORD_MESSAGE_LIMIT - 1]
+        if len(message) + len(line) + 1 > DISCORD_MESSAGE_LIMIT:
+            await ctx.send(message)
+            message = ""
+        message += line + "\n"
+    await ctx.send(message)
+
+# Expire every active key past its deadline in one transaction; returns (key, user_id) pairs
+def expire_keys(now):
+    with db_cursor() as cursor:
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT key, user_id FROM keys WHERE status = 'active' AND expiration <= ?", (now,))
+        expired = cursor.fetchall()
+        if expired:
+            cursor.execute("UPDATE keys SET status = 'inactive' WHERE status = 'active' AND expiration <= ?", (now,))
+    return expired
 
-# Task to check expired keys
-@tasks.loop(minutes=60)  # Check every hour
 async def check_expired_keys():
-    cursor.execute("SELECT * FROM keys WHERE status = 'active'")
-    keys = cursor.fetchall()
-    guild = bot.get_guild(int(GUILD_ID))
-    log_channel = discord.utils.get(guild.channels, name="logs")
+    # Off the event loop: a large batch or a contended write lock would stall heartbeats
+    expired = await asyncio.to_thread(expire_keys, time.time())
+    if not expired:
+        return
+    key_cache.invalidate(*[key_value for key_value, _ in expired])
+
+    for key_value, user_id in expired:
+        log_sink.log(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Key `{key_value}` has expired for user {user_id}")
+
+    # Remove VIP role from users left without an active key
+    await vip_reconciler.reconcile([user_id for _, user_id in expired if user_id], "due to key expiration")
+
+# Periodic full VIP role reconciliation
+@tasks.loop(minutes=VIP_RECONCILE_MINUTES)
+async def reconcile_vip_roles():
+    added, removed = await vip_reconciler.reconcile()
+    if added or removed:
+        print(f"VIP reconciliation queued {added} additions and {removed} removals.")
+
+# Key expiration scheduler. Keeps the soonest deadlines of active keys in a heap and
+# sleeps until the next one; write paths call resync() when expirations change.
+EXPIRY_HEAP_SIZE = int(os.getenv("EXPIRY_HEAP_SIZE", 1000))
+EXPIRY_MAX_SLEEP = float(os.getenv("EXPIRY_MAX_SLEEP", 3600))
+EXPIRY_RETRY_DELAY = float(os.getenv("EXPIRY_RETRY_DELAY", 5))
+
+class ExpirationScheduler:
+    def __init__(self, heap_size, max_sleep, retry_delay):
+        self.heap_size = heap_size
+        self.max_sleep = max_sleep
+        self.retry_delay = retry_delay
+        self._heap = []
+        self._resync = True
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+
+    def is_running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = self._loop.create_task(self._run())
+
+    def resync(self):
+        # Safe to call from any thread
+        self._resync = True
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _load(self):
+        with db_cursor() as cursor:
+            cursor.execute("SELECT expiration, key FROM keys WHERE status = 'active' AND expiration IS NOT NULL ORDER BY expiration LIMIT ?",
+                           (self.heap_size,))
+            heap = cursor.fetchall()
+        heapq.heapify(heap)
+        self._heap = heap
+
+    async def _run(self):
+        while True:
+            if self._resync:
+                self._resync = False
+                try:
+                    self._load()
+                except Exception as e:
+                    print(f"Expiration scheduler failed to load deadlines: {e}")
+            now = time.time()
+            if self._heap and self._heap[0][0] <= now:
+                try:
+                    with expire_run_seconds.time():
+                        await check_expired_keys()
+                except Exception as e:
+                    # Keep the deadlines and retry from a fresh load shortly
+                    print(f"Failed to expire keys, retrying in {self.retry_delay}s: {e}")
+                    self._resync = True
+                    await asyncio.sleep(self.retry_delay)
+                    continue
+                while self._heap and self._heap[0][0] <= now:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._resync = True
+                continue
+            timeout = self.max_sleep
+            if self._heap:
+                timeout = min(timeout, self._heap[0][0] - now)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                # Periodic resync picks up changes made outside this process
+                if timeout == self.max_sleep:
+                    self._resync = True
+            self._wakeup.clear()
+
+expiration_scheduler = ExpirationScheduler(EXPIRY_HEAP_SIZE, EXPIRY_MAX_SLEEP, EXPIRY_RETRY_DELAY)
+
+# Control panel messages. Their IDs and a fingerprint of the posted embed and buttons
+# are stored, so startup and the refresh task go straight to the message and skip the
+# edit when nothing changed.
+def admin_panel():
+    admin_embed = discord.Embed(
+        title="Admin Controls",
+        description="Manage VIP keys, users, and maintenance with the buttons below.",
+        color=discord.Color.red()
+    )
+    admin_embed.set_footer(text="Powered by ZLI Hacks")
+    return admin_embed, AdminView()
+
+def tickets_panel():
+    ticket_embed = discord.Embed(
+        title="Support Tickets",
+        description="Open a ticket to report a bug or request payment information.",
+        color=discord.Color.red()
+    )
+    ticket_embed.set_footer(text="Powered by ZLI Hacks")
+    return ticket_embed, TicketView()
 
-    for key in keys:
-        key_value, user_id, expiration, status, registration_date, android_uid = key
-        expiration_date = datetime.fromisoformat(expiration)
-        if datetime.now() > expiration_date:
-            cursor.execute("UPDATE keys SET status = 'inactive' WHERE key = ?", (key_value,))
-            db.commit()
-            if log_channel:
-                await log_channel.send(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Key `{key_value}` has expired for user {user_id}")
+# name -> (registry channel, builder)
+CONTROL_PANELS = {
+    "admin": ("admin", admin_panel),
+    "tickets": ("buy-hack-ticket", tickets_panel),
+}
 
-            # Remove VIP role from user
-            member = guild.get_member(int(user_id))
-            if member:
-                vip_role = guild.get_role(int(VIP_ROLE_ID))
-                if vip_role and vip_role in member.roles:
-                    await member.remove_roles(vip_role)
-                    if log_channel:
-                        await log_channel.send(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] VIP role removed from user {user_id} due to key expiration")
+def panel_fingerprint(embed, view):
+    payload = json.dumps([embed.to_dict(), view.to_components()], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
 
-# Task to refresh messages periodically to prevent interaction expiration
-@tasks.loop(minutes=10)
-async def refresh_messages():
-    guild = bot.get_guild(int(GUILD_ID))
-    if not guild:
+class ControlMessages:
+    def __init__(self):
+        self._rows = {}  # name -> (channel_id, message_id, fingerprint)
+        self._locks = {}
+
+    def lock(self, name):
+        # Created lazily so they belong to the bot's event loop
+        if name not in self._locks:
+            self._locks[name] = asyncio.Lock()
+        return self._locks[name]
+
+    def load(self):
+        with db_cursor() as cursor:
+            cursor.execute("SELECT name, channel_id, message_id, fingerprint FROM control_messages")
+            self._rows = {name: (channel_id, message_id, fingerprint) for name, channel_id, message_id, fingerprint in cursor}
+
+    def get(self, name):
+        return self._rows.get(name)
+
+    def find(self, message_id):
+        return next((name for name, row in self._rows.items() if row[1] == message_id), None)
+
+    def save(self, name, channel_id, message_id, fingerprint):
+        with db_cursor() as cursor:
+            cursor.execute("INSERT OR REPLACE INTO control_messages (name, channel_id, message_id, fingerprint) VALUES (?, ?, ?, ?)",
+                           (name, channel_id, message_id, fingerprint))
+        self._rows[name] = (channel_id, message_id, fingerprint)
+
+    def forget(self, name):
+        with db_cursor() as cursor:
+            cursor.execute("DELETE FROM control_messages WHERE name = ?", (name,))
+        self._rows.pop(name, None)
+
+control_messages = ControlMessages()
+control_messages.load()
+
+async def ensure_control_message(name, verify=False):
+    # Post or update a control panel; with verify, also check an unchanged one still exists
+    async with control_messages.lock(name):
+        await sync_control_message(name, verify)
+
+async def sync_control_message(name, verify):
+    channel_name, build = CONTROL_PANELS[name]
+    channel = registry.channel(channel_name)
+    if not channel:
         return
-
-    admin_channel = discord.utils.get(guild.channels, name="admin")
-    tickets_channel = discord.utils.get(guild.channels, name="tickets")
-
-    if admin_channel:
-        async for message in admin_channel.history(limit=10):
-            if message.author == bot.user and message.embeds and "Admin Controls" in message.embeds[0].title:
-                admin_embed = discord.Embed(
-                    title="Admin Controls",
-                    description="Manage VIP keys, users, and maintenance with the buttons below.",
-                    color=discord.Color.red()
-                )
-                admin_embed.set_footer(text="Powered by ZLI Hacks")
-                await message.edit(embed=admin_embed, view=AdminView())
+    embed, view = build()
+    fingerprint = panel_fingerprint(embed, view)
+    stored = control_messages.get(name)
+    message = None
+    if stored and stored[0] == channel.id:
+        message = channel.get_partial_message(stored[1])
+        if stored[2] == fingerprint:
+            if not verify:
+                return
+            try:
+                await message.fetch()
+                return
+            except discord.NotFound:
+                message = None
+    elif stored is None:
+        # First run with this table: adopt the panel posted by an older version
+        async for candidate in channel.history(limit=10):
+            if candidate.author == bot.user and candidate.embeds and candidate.embeds[0].title == embed.title:
+                message = candidate
                 break
 
-    if tickets_channel:
-        async for message in tickets_channel.history(limit=10):
-            if message.author == bot.user and message.embeds and "Support Tickets" in message.embeds[0].title:
-                ticket_embed = discord.Embed(
-                    title="Support Tickets",
-                    description="Open a ticket to report a bug or request payment information.",
-                    color=discord.Color.red()
-                )
-                ticket_embed.set_footer(text="Powered by ZLI Hacks")
-                await message.edit(embed=ticket_embed, view=TicketView())
-                break
+    if message:
+        try:
+            await message.edit(embed=embed, view=view)
+            print(f"Updated existing {name} message.")
+        except discord.NotFound:
+            message = None
+    if message is None:
+        message = await channel.send(embed=embed, view=view)
+        print(f"Sent new {name} message.")
+    control_messages.save(name, channel.id, message.id, fingerprint)
+
+# Re-post or update the control panels when they are missing or outdated
+@tasks.loop(minutes=10)
+async def refresh_messages():
+    if not registry.guild:
+        return
+    for name in CONTROL_PANELS:
+        try:
+            await ensure_control_message(name)
+        except discord.HTTPException as e:
+            print(f"Failed to refresh {name} message: {e}")
 
 # Register persistent views
 def setup_persistent_views():
@@ -650,147 +3016,188 @@ def setup_persistent_views():
     bot.add_view(TicketView())
     bot.add_view(TicketActionsView())
 
-# Startup event with channel setup
+# Guild provisioning: categories, channels and their initial messages. Runs once per
+# process; independent steps run concurrently and each step's timing is logged.
+# One-shot messages are recorded in setup_state so restarts skip their history checks.
+SETUP_CHANNELS = {  # channel -> (category, private)
+    "admin": ("ZLI Management", True),
+    "buy-hack-ticket": ("Tickets", False),
+    "logs": ("ZLI Management", True),
+    "keys": ("ZLI Management", True),
+}
+
+class SetupState:
+    def __init__(self):
+        self._steps = {}  # step -> object_id
+
+    def load(self):
+        with db_cursor() as cursor:
+            cursor.execute("SELECT step, object_id FROM setup_state")
+            self._steps = dict(cursor.fetchall())
+
+    def get(self, step):
+        return self._steps.get(step)
+
+    def record(self, step, object_id, duration_ms):
+        with db_cursor() as cursor:
+            cursor.execute("INSERT OR REPLACE INTO setup_state (step, object_id, completed_at, duration_ms) VALUES (?, ?, ?, ?)",
+                           (step, object_id, int(time.time()), int(duration_ms)))
+        self._steps[step] = object_id
+
+setup_state = SetupState()
+setup_state.load()
+
+async def timed_step(name, coro):
+    started = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        print(f"Setup step '{name}' took {(time.perf_counter() - started) * 1000:.0f} ms")
+
+async def run_setup_steps(steps):
+    # Run (name, coroutine) pairs concurrently; raise after all finished if any failed
+    results = await asyncio.gather(*(timed_step(name, coro) for name, coro in steps), return_exceptions=True)
+    failed = [(name, result) for (name, _), result in zip(steps, results) if isinstance(result, BaseException)]
+    for name, error in failed:
+        print(f"Setup step '{name}' failed: {error}")
+    if failed:
+        raise RuntimeError(f"{len(failed)} setup step(s) failed")
+    return results
+
+async def ensure_category(guild, name):
+    category = registry.category(name)
+    if not category:
+        category = await guild.create_category(name)
+        registry.register("category", name, category)
+        print(f"Category '{name}' created.")
+    return category
+
+async def ensure_channel(guild, name, category, overwrites):
+    channel = registry.channel(name)
+    if not channel:
+        channel = await guild.create_text_channel(name, category=category, overwrites=overwrites or {})
+        registry.register("channel", name, channel)
+        print(f"Channel '{name}' created.")
+    return channel
+
+async def post_once(step, channel, post):
+    # Post the channel's initial message if it is empty; done once per channel
+    if setup_state.get(step) == channel.id:
+        return
+    started = time.perf_counter()
+    async for message in channel.history(limit=1):
+        if message.author == bot.user:
+            break
+    else:
+        await post(channel)
+    setup_state.record(step, channel.id, (time.perf_counter() - started) * 1000)
+
+async def provision_guild(guild):
+    started = time.perf_counter()
+    private_overwrites = {
+        guild.default_role: discord.PermissionOverwrite(view_channel=False),
+        guild.get_role(int(ADMIN_ROLE_ID)): discord.PermissionOverwrite(view_channel=True, send_messages=True)
+    }
+    categories = await run_setup_steps([(f"category {name}", ensure_category(guild, name)) for name in REGISTRY_CATEGORIES])
+    categories = dict(zip(REGISTRY_CATEGORIES, categories))
+    await run_setup_steps([
+        (f"channel {name}", ensure_channel(guild, name, categories[category], private_overwrites if private else None))
+        for name, (category, private) in SETUP_CHANNELS.items()
+    ])
+    await run_setup_steps([
+        ("admin panel", ensure_control_message("admin", verify=True)),
+        ("tickets panel", ensure_control_message("tickets", verify=True)),
+        ("logs intro", post_once("logs_intro", registry.channel("logs"), lambda channel: channel.send(
+            "Logs will appear here when the script is executed or actions are performed."))),
+        ("keys export", post_once("keys_export", registry.channel("keys"), lambda channel: send_keys_export(
+            channel.send, KeyFilter("all"), "Existing Keys"))),
+    ])
+    duration_ms = (time.perf_counter() - started) * 1000
+    setup_state.record("provisioned", guild.id, duration_ms)
+    print(f"Guild setup finished in {duration_ms:.0f} ms")
+
+provisioning = None  # the provisioning task, once started
+
+# Startup event. discord.py fires on_ready again after reconnects; only the first
+# call (or one after a failed setup) provisions the guild.
 @bot.event
 async def on_ready():
+    global provisioning
     print(f"Bot logged in as {bot.user}")
     guild = bot.get_guild(int(GUILD_ID))
     if not guild:
         print("Guild not found! Check GUILD_ID.")
         return
 
-    # Register persistent views
-    setup_persistent_views()
+    # Resolve channels, categories and roles
+    registry.bind(guild)
 
-    # Start the refresh task
-    if not refresh_messages.is_running():
-        refresh_messages.start()
+    if provisioning is not None and not (provisioning.done() and (provisioning.cancelled() or provisioning.exception())):
+        return
 
-    # Define permissions for private channels (logs and keys)
-    private_overwrites = {
-        guild.default_role: discord.PermissionOverwrite(view_channel=False),
-        guild.get_role(int(ADMIN_ROLE_ID)): discord.PermissionOverwrite(view_channel=True, send_messages=True)
-    }
+    if provisioning is None:
+        # Register persistent views
+        setup_persistent_views()
+
+        # Start the background tasks
+        if not refresh_messages.is_running():
+            refresh_messages.start()
+        if not log_sink.is_running():
+            log_sink.start()
+        if not vip_reconciler.is_running():
+            vip_reconciler.start()
+        if PROCESS_ROLE == "bot" and not outbox.is_running():
+            outbox.start()
+        if not reconcile_vip_roles.is_running():
+            reconcile_vip_roles.start()
+        if not expiration_scheduler.is_running():
+            expiration_scheduler.start()
+        if not audit_log.is_running():
+            audit_log.start()
+
+    provisioning = asyncio.get_running_loop().create_task(provision_guild(guild))
+    try:
+        await provisioning
+    except Exception as e:
+        print(f"Guild setup failed, will retry on the next ready event: {e}")
 
-    management_category = discord.utils.get(guild.categories, name="ZLI Management")
-    if not management_category:
-        management_category = await guild.create_category("ZLI Management")
-        print("Category 'ZLI Management' created.")
-
-    tickets_category = discord.utils.get(guild.categories, name="Tickets")
-    if not tickets_category:
-        tickets_category = await guild.create_category("Tickets")
-        print("Category 'Tickets' created.")
-
-    admin_channel = discord.utils.get(guild.channels, name="admin")
-    if not admin_channel:
-        admin_channel = await guild.create_text_channel(
-            "admin",
-            category=management_category,
-            overwrites={
-                guild.default_role: discord.PermissionOverwrite(view_channel=False),
-                guild.get_role(int(ADMIN_ROLE_ID)): discord.PermissionOverwrite(view_channel=True, send_messages=True)
-            }
-        )
-        print("Channel 'admin' created.")
+# Error handler for interactions
+@bot.event
+async def on_interaction_error(interaction: discord.Interaction, error: Exception):
+    await interaction.response.send_message("An error occurred while processing your request. Please try again later.", ephemeral=True)
+    print(f"Interaction error: {error}")
 
-    # Check if an admin message already exists
-    admin_message = None
-    async for message in admin_channel.history(limit=10):
-        if message.author == bot.user and message.embeds and "Admin Controls" in message.embeds[0].title:
-            admin_message = message
-            break
+# Re-post a control panel as soon as someone deletes it
+@bot.event
+async def on_raw_message_delete(payload):
+    name = control_messages.find(payload.message_id)
+    if name:
+        control_messages.forget(name)
+        await ensure_control_message(name)
 
-    admin_embed = discord.Embed(
-        title="Admin Controls",
-        description="Manage VIP keys, users, and maintenance with the buttons below.",
-        color=discord.Color.red()
-    )
-    admin_embed.set_footer(text="Powered by ZLI Hacks")
-    
-    if admin_message:
-        # Update the existing message
-        await admin_message.edit(embed=admin_embed, view=AdminView())
-        print("Updated existing admin message.")
-    else:
-        # Send a new message if none exists
-        await admin_channel.send(embed=admin_embed, view=AdminView())
-        print("Sent new admin message.")
-
-    tickets_channel = discord.utils.get(guild.channels, name="buy-hack-ticket")
-    if not tickets_channel:
-        tickets_channel = await guild.create_text_channel("buy-hack-ticket", category=tickets_category)
-        print("Channel 'buy-hack-ticket' created.")
-
-    # Check if a tickets message already exists
-    tickets_message = None
-    async for message in tickets_channel.history(limit=10):
-        if message.author == bot.user and message.embeds and "Support Tickets" in message.embeds[0].title:
-            tickets_message = message
-            break
+# Keep the registry in sync with channel changes
+@bot.event
+async def on_guild_channel_create(channel):
+    if channel.guild.id == registry.guild_id:
+        registry.channel_created(channel)
 
-    ticket_embed = discord.Embed(
-        title="Support Tickets",
-        description="Open a ticket to report a bug or request payment information.",
-        color=discord.Color.red()
-    )
-    ticket_embed.set_footer(text="Powered by ZLI Hacks")
-    
-    if tickets_message:
-        # Update the existing message
-        await tickets_message.edit(embed=ticket_embed, view=TicketView())
-        print("Updated existing tickets message.")
-    else:
-        # Send a new message if none exists
-        await tickets_channel.send(embed=ticket_embed, view=TicketView())
-        print("Sent new tickets message.")
-
-    logs_channel = discord.utils.get(guild.channels, name="logs")
-    if not logs_channel:
-        logs_channel = await guild.create_text_channel(
-            "logs",
-            category=management_category,
-            overwrites=private_overwrites
-        )
-        print("Channel 'logs' created.")
-    # Only send the initial log message if the channel is empty
-    async for message in logs_channel.history(limit=1):
-        if message.author == bot.user:
-            break
-    else:
-        await logs_channel.send("Logs will appear here when the script is executed or actions are performed.")
-
-    keys_channel = discord.utils.get(guild.channels, name="keys")
-    if not keys_channel:
-        keys_channel = await guild.create_text_channel(
-            "keys",
-            category=management_category,
-            overwrites=private_overwrites
-        )
-        print("Channel 'keys' created.")
-    
-    # Only send the keys message if the channel is empty
-    async for message in keys_channel.history(limit=1):
-        if message.author == bot.user:
-            break
-    else:
-        cursor.execute("SELECT * FROM keys")
-        keys = cursor.fetchall()
-        if keys:
-            keys_list = "\n".join([f"Key: `{k[0]}` | User: <@{k[1]}> | Registered: {k[4].split('T')[0]} | Expires: {k[2].split('T')[0]} | Status: {k[3]}" for k in keys])
-            await keys_channel.send(f"**Existing Keys:**\n{keys_list}")
-        else:
-            await keys_channel.send("No keys registered yet.")
+@bot.event
+async def on_guild_channel_delete(channel):
+    if channel.guild.id == registry.guild_id:
+        registry.channel_deleted(channel)
+        ticket_store.channel_deleted(channel.id)
 
-    # Start the task to check expired keys
-    if not check_expired_keys.is_running():
-        check_expired_keys.start()
+@bot.event
+async def on_thread_delete(thread):
+    if thread.guild.id == registry.guild_id:
+        ticket_store.channel_deleted(thread.id)
 
-# Error handler for interactions
 @bot.event
-async def on_interaction_error(interaction: discord.Interaction, error: Exception):
-    await interaction.response.send_message("An error occurred while processing your request. Please try again later.", ephemeral=True)
-    print(f"Interaction error: {error}")
+async def on_guild_channel_update(before, after):
+    # Bindings are by ID, so renames need no change; a channel renamed to a
+    # tracked name that has no binding yet picks it up
+    if after.guild.id == registry.guild_id:
+        registry.channel_created(after)
 
 # Connection monitoring
 @bot.event
@@ -805,8 +3212,61 @@ async def on_connect():
 async def on_resumed():
     print("Bot session resumed.")
 
-# Start Flask and the bot
+# Run the license API in the configured server mode
+def run_api_server(port, sockets=None):
+    if API_SERVER == "dev":
+        app.run(host=API_HOST, port=port, threaded=True)
+    elif API_SERVER == "waitress":
+        from waitress import serve
+        listen = {"sockets": sockets} if sockets else {"host": API_HOST, "port": port}
+        serve(
+            app,
+            threads=API_THREADS,
+            connection_limit=API_CONNECTION_LIMIT,
+            channel_timeout=API_KEEPALIVE_TIMEOUT,
+            **listen
+        )
+    else:
+        raise ValueError(f"Unknown API_SERVER mode: {API_SERVER}")
+
+# Background threads every API process needs
+def start_api_workers():
+    usage_recorder.start()
+    if PROCESS_ROLE != "all":
+        process_sync.start()
+
+def api_worker_process(sock):
+    db_pool.reset()
+    start_api_workers()
+    run_api_server(None, [sock])
+
+# API-only mode: API_PROCESSES forked workers accept on one shared listening socket
+def run_api_processes(port):
+    if API_PROCESSES <= 1 or API_SERVER != "waitress":
+        start_api_workers()
+        run_api_server(port)
+        return
+    import multiprocessing
+    import socket
+    sock = socket.create_server((API_HOST, port))
+    db_pool.close_idle()
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=api_worker_process, args=(sock,), daemon=True) for _ in range(API_PROCESSES)]
+    for worker in workers:
+        worker.start()
+    print(f"Started {len(workers)} API processes on port {port}")
+    for worker in workers:
+        worker.join()
+
+# Start Flask and/or the bot depending on PROCESS_ROLE
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 5031))
-    threading.Thread(target=lambda: app.run(host="0.0.0.0", port=port)).start()
-    bot.run(os.getenv("DISCORD_TOKEN"))
+    if PROCESS_ROLE == "api":
+        run_api_processes(port)
+    else:
+        if PROCESS_ROLE == "all":
+            start_api_workers()
+            threading.Thread(target=run_api_server, args=(port,), daemon=True).start()
+        else:
+            process_sync.start()
+        bot.run(os.getenv("DISCORD_TOKEN"))